@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Benchmarks the master equation methods in MEASURE on synthetic networks, so
+that changes to the solvers can be checked for performance regressions. Run
+the benchmarks via ::
+
+$ python benchmark.py [-o RESULTS] [--compare BASELINE]
+
+Each network is generated from its numbers of isomers, reactant channels, and
+product channels alone, with harmonic oscillator densities of states and 
+path reactions given by Arrhenius expressions (using the inverse Laplace 
+transform method), so no external data is needed. By default a set of 
+networks of increasing size is run with each method; a single network can
+instead be chosen with the ``--isomers``, ``--reactants``, ``--products``,
+``--grains``, ``--temperatures``, and ``--pressures`` arguments. Energy
+grains that are not evenly spaced are used if ``--max-grain-size`` is given,
+and the grains are refined until the rate coefficients converge if 
+``--converge`` is given. Each calculation is run in full and profiled by
+:class:`measure.timing.Profiler`; the time spent in each of its stages is
+printed, and saved as JSON to the ``-o`` file if given. Passing a previously saved file as ``--compare`` 
+reports the change in each timing relative to it, and exits with a nonzero
+status if any stage is slower than the ``--threshold`` allows.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import numpy
+
+################################################################################
+
+# The methods to benchmark, indexed by the short names used in case names
+methods = {
+    'msc': 'modified strong collision',
+    'rs': 'reservoir state',
+    'cse': 'chemically-significant eigenvalues',
+}
+
+# The networks benchmarked by default, as tuples of the numbers of isomers,
+# reactant channels, product channels, energy grains, temperatures, and
+# pressures
+defaultCases = [
+    (2, 1, 1, 200, 4, 3),
+    (3, 1, 1, 400, 8, 5),
+    (5, 2, 2, 400, 8, 5),
+    (6, 2, 2, 400, 6, 4),
+]
+
+# The stages of the calculation recorded by the profiler, in the order in 
+# which they run
+stages = [
+    'calculateRateCoefficients',
+    'calculateDensitiesOfStates',
+    'calculateSumsOfStates',
+    'calculateMicrocanonicalRates',
+    'calculateRateCoefficientsAtTemperature',
+    'calculateCollisionEfficiency',
+    'generateBandedCollisionMatrix',
+    'applyModifiedStrongCollisionMethod',
+    'applyReservoirStateMethod',
+    'applyChemicallySignificantEigenvaluesMethod',
+]
+
+################################################################################
+
+def generateNetwork(Nisom, Nreac, Nprod, seed=0):
+    """
+    Generate and return a synthetic unimolecular reaction network with 
+    `Nisom` isomers, `Nreac` reactant channels, and `Nprod` product channels.
+    The isomers are connected in a chain by isomerization reactions, and each
+    reactant and product channel is connected to one of the isomers. The 
+    energies and vibrational frequencies are chosen pseudorandomly from 
+    `seed`, so the same arguments always give the same network.
+    """
+    
+    from chempy.species import Species, TransitionState, LennardJones
+    from chempy.reaction import Reaction
+    from chempy.states import StatesModel, HarmonicOscillator
+    from chempy.kinetics import ArrheniusModel
+    from measure.network import Network
+    from measure.collision import SingleExponentialDownModel
+    
+    random = numpy.random.RandomState(seed)
+    lennardJones = LennardJones(5.0e-10, 400 * 1.380658e-23)
+    
+    def generateSpecies(label, E0, Nfreq):
+        frequencies = sorted(random.uniform(300.0, 3200.0, Nfreq))
+        spec = Species(label=label, states=StatesModel([HarmonicOscillator(frequencies)]), E0=E0, lennardJones=lennardJones)
+        spec.molecularWeight = 0.001 * (12 + 2 * Nfreq)
+        return spec
+    
+    def generateReaction(reactants, products, reversible):
+        E0 = max(sum([spec.E0 for spec in reactants]), sum([spec.E0 for spec in products])) + random.uniform(100000.0, 200000.0)
+        Ea = E0 - sum([spec.E0 for spec in reactants])
+        kinetics = ArrheniusModel(A=10**random.uniform(12.0, 14.0), n=0.0, Ea=Ea)
+        return Reaction(reactants=reactants, products=products, reversible=reversible, kinetics=kinetics, transitionState=TransitionState(E0=E0))
+    
+    isomers = [generateSpecies('isomer%i' % (i+1), random.uniform(0.0, 40000.0), 18) for i in range(Nisom)]
+    reactants = [sorted([generateSpecies('reactant%iA' % (n+1), random.uniform(40000.0, 80000.0), 9), 
+        generateSpecies('reactant%iB' % (n+1), 0.0, 3)]) for n in range(Nreac)]
+    products = [sorted([generateSpecies('product%iA' % (n+1), random.uniform(40000.0, 80000.0), 9), 
+        generateSpecies('product%iB' % (n+1), 0.0, 3)]) for n in range(Nprod)]
+    
+    pathReactions = []
+    for i in range(Nisom - 1):
+        pathReactions.append(generateReaction([isomers[i]], [isomers[i+1]], True))
+    for n in range(Nreac):
+        pathReactions.append(generateReaction([isomers[n % Nisom]], reactants[n], True))
+    for n in range(Nprod):
+        pathReactions.append(generateReaction([isomers[(Nisom - 1 - n) % Nisom]], products[n], False))
+    
+    bathGas = generateSpecies('bathGas', 0.0, 1)
+    bathGas.molecularWeight = 0.028
+    
+    network = Network(isomers=isomers, reactants=reactants, products=products, pathReactions=pathReactions, bathGas=bathGas)
+    network.collisionModel = SingleExponentialDownModel(alpha=2000.0 * 4.184)
+    return network
+
+################################################################################
+
+def timeStages(network, Tlist, Plist, Elist, method, collisionTolerance=1e-8, converge=None):
+    """
+    Calculate the rate coefficients of the `network` at the temperatures 
+    `Tlist` in K and pressures `Plist` in Pa using the energy grains `Elist`
+    in J/mol and the given `method`, and return a dictionary of the time in
+    s spent in each stage of the calculation, as recorded by a 
+    :class:`Profiler` (without measuring memory) passed to 
+    :meth:`Network.calculateRateCoefficients`, and indexed by the names of
+    the stages it uses; ``'total'`` is the time taken by the whole 
+    calculation. If `converge` is given, the rate coefficients are instead
+    calculated by :meth:`Network.calculateConvergedRateCoefficients` with 
+    that tolerance.
+    """
+    
+    from measure.timing import Profiler
+    
+    profile = Profiler(memory=False)
+    t0 = time.time()
+    if converge is not None:
+        network.calculateConvergedRateCoefficients(Tlist, Plist, Elist, method, tolerance=converge, collisionTolerance=collisionTolerance, profile=profile)
+    else:
+        network.calculateRateCoefficients(Tlist, Plist, Elist, method, collisionTolerance=collisionTolerance, profile=profile)
+    timings = dict([(stage, data['time']) for stage, data in profile.stages.items()])
+    timings['total'] = time.time() - t0
+    
+    return timings
+
+def getStages(timings):
+    """
+    Return the names of the stages in the dictionary `timings`, in the order
+    in which they run, followed by any others and then ``'total'``.
+    """
+    names = [stage for stage in stages if stage in timings]
+    names.extend(sorted([stage for stage in timings if stage not in stages and stage != 'total']))
+    if 'total' in timings: names.append('total')
+    return names
+
+def runBenchmarks(cases, methodNames, repeat=1, collisionTolerance=1e-8, maxGrainSize=0.0, converge=None):
+    """
+    Run the benchmark for each of the `cases`, tuples of the numbers of 
+    isomers, reactant channels, product channels, energy grains, temperatures,
+    and pressures, with each of the methods whose short names are in 
+    `methodNames`. Each calculation is run `repeat` times and the shortest 
+    time for each stage is kept. If `maxGrainSize` is given, the energy 
+    grains are not evenly spaced but grow up to that size in J/mol away from
+    the reaction thresholds; if `converge` is given, the energy grains are
+    refined until the rate coefficients converge to that relative tolerance.
+    Returns a list of dictionaries, one per case and method.
+    """
+    
+    results = []
+    for Nisom, Nreac, Nprod, Ngrains, NT, NP in cases:
+        network = generateNetwork(Nisom, Nreac, Nprod)
+        Tlist = numpy.linspace(300.0, 2000.0, NT)
+        Plist = numpy.logspace(3.0, 7.0, NP)
+        Elist = network.autoGenerateEnergyGrains(Tmax=max(Tlist), Ngrains=Ngrains, maxGrainSize=maxGrainSize)
+        for methodName in methodNames:
+            name = '%s-%ii%ir%ip-%ig-%ix%i' % (methodName, Nisom, Nreac, Nprod, Ngrains, NT, NP)
+            timings = {}
+            for r in range(repeat):
+                for stage, value in timeStages(network, Tlist, Plist, Elist, methods[methodName], collisionTolerance, converge).items():
+                    timings[stage] = min(value, timings.get(stage, value))
+            results.append({
+                'name': name, 'method': methods[methodName], 
+                'Nisom': Nisom, 'Nreac': Nreac, 'Nprod': Nprod, 'Ngrains': len(Elist), 'NT': NT, 'NP': NP,
+                'timings': timings,
+            })
+            print(name)
+            for stage in getStages(timings):
+                print('    %-44s %10.3f s' % (stage, timings[stage]))
+    return results
+
+def compareResults(results, baseline, threshold=0.2, minimumTime=0.01):
+    """
+    Compare the benchmark `results` to those in `baseline`, printing the 
+    ratio of each timing to its baseline value. A stage is flagged as a 
+    regression if it is more than `threshold` (as a fraction) slower than in
+    the baseline and also slower by more than `minimumTime` in s, so that 
+    noise in very short timings is ignored. Returns the list of regressions 
+    as ``(name, stage, time, baselineTime)`` tuples.
+    """
+    
+    baselineTimings = dict([(case['name'], case['timings']) for case in baseline['results']])
+    regressions = []
+    for case in results:
+        if case['name'] not in baselineTimings:
+            print('%-32s not in baseline' % case['name'])
+            continue
+        print(case['name'])
+        for stage in getStages(case['timings']):
+            t, t0 = case['timings'][stage], baselineTimings[case['name']].get(stage)
+            if t0 is None: continue
+            ratio = t / t0 if t0 > 0 else float('inf')
+            flag = ''
+            if t > t0 * (1 + threshold) and t - t0 > minimumTime:
+                regressions.append((case['name'], stage, t, t0))
+                flag = '  (regression)'
+            print('    %-44s %9.2fx%s' % (stage, ratio, flag))
+    return regressions
+
+################################################################################
+
+def parseCommandLineArguments():
+    """
+    Parse the command-line arguments being passed to the benchmark. These are
+    described in the module docstring.
+    """
+    
+    parser = argparse.ArgumentParser(description='Benchmark the MEASURE master equation methods on synthetic networks.')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, default=None,
+        help='a file in which to save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', type=str, default=None,
+        help='a file of saved results to compare against')
+    parser.add_argument('--threshold', metavar='FRAC', type=float, default=0.2,
+        help='the fraction by which a stage must be slower than the baseline to be a regression (default is 0.2)')
+    parser.add_argument('--method', metavar='METHOD', type=str, nargs='+', choices=sorted(methods.keys()), default=['msc', 'rs', 'cse'],
+        help='the methods to benchmark (default is msc rs cse)')
+    parser.add_argument('--repeat', metavar='N', type=int, default=1,
+        help='the number of times to run each benchmark, keeping the fastest (default is 1)')
+    parser.add_argument('--tolerance', metavar='TOL', type=float, default=1e-8,
+        help='the collision tolerance to use (default is 1e-8)')
+    parser.add_argument('--isomers', metavar='N', type=int, default=None,
+        help='benchmark a single network with this many isomers')
+    parser.add_argument('--reactants', metavar='N', type=int, default=1,
+        help='the number of reactant channels in the single network (default is 1)')
+    parser.add_argument('--products', metavar='N', type=int, default=1,
+        help='the number of product channels in the single network (default is 1)')
+    parser.add_argument('--grains', metavar='N', type=int, default=400,
+        help='the number of energy grains in the single network (default is 400)')
+    parser.add_argument('--temperatures', metavar='N', type=int, default=8,
+        help='the number of temperatures for the single network (default is 8)')
+    parser.add_argument('--pressures', metavar='N', type=int, default=5,
+        help='the number of pressures for the single network (default is 5)')
+    parser.add_argument('--max-grain-size', metavar='DE', type=float, default=0.0,
+        help='use energy grains that are not evenly spaced, growing up to this size in J/mol')
+    parser.add_argument('--converge', metavar='TOL', type=float, default=None,
+        help='refine the energy grains until no k(T,P) value changes by more than this relative tolerance')
+    
+    return parser.parse_args()
+
+################################################################################
+
+if __name__ == '__main__':
+    
+    args = parseCommandLineArguments()
+    
+    # Only errors from the calculations themselves are shown, so that the
+    # timings are not lost among the warnings
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s: %(message)s')
+    
+    if args.isomers is not None:
+        cases = [(args.isomers, args.reactants, args.products, args.grains, args.temperatures, args.pressures)]
+    else:
+        cases = defaultCases
+    
+    results = runBenchmarks(cases, args.method, args.repeat, args.tolerance, args.max_grain_size, args.converge)
+    
+    if args.output is not None:
+        f = open(args.output, 'w')
+        try:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'platform': platform.platform(),
+                'date': time.asctime(),
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+    
+    if args.compare is not None:
+        f = open(args.compare, 'r')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        print('')
+        print('Timings relative to %s:' % args.compare)
+        regressions = compareResults(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print('')
+            for name, stage, t, t0 in regressions:
+                print('Regression in %s (%s): %.3f s vs. %.3f s' % (name, stage, t, t0))
+            sys.exit(1)
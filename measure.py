@@ -37,6 +37,60 @@ where ``FILE`` is the path to a valid MEASURE input file describing the job
 to be run and providing the necessary information about the unimolecular
 reaction network. Other command-line arguments control the level of 
 verbosity of information printed to the console.
+
+The ``-j N`` (or ``--jobs N``) argument distributes the calculation over 
+``N`` worker processes.
+
+Densities of states can be cached between runs by passing a cache 
+directory via ``--cache DIR``.
+
+The ``--tolerance TOL`` argument sets the relative size below which 
+collision matrix entries are neglected, which controls the bandwidth (and
+so the cost) of the reservoir state method.
+
+The ``-o FILE`` (or ``--output FILE``) argument saves the rate coefficients
+to a binary file that can be read with :func:`measure.output.loadResults`;
+add ``--populations`` to save the population distributions as well.
+
+Passing ``--fit`` fits the computed rate coefficients to Chebyshev 
+polynomials, with the numbers of terms set by ``--chebyshev NT NP``, and to
+pressure-dependent Arrhenius expressions. The fitted parameters are logged
+and, with ``-o FILE``, saved to the output file; see 
+:func:`measure.output.loadFit`.
+
+Long calculations can be checkpointed by passing ``--checkpoint FILE``, 
+which saves each k(T,P) value as soon as it is computed (or, with ``-j N``,
+each temperature as soon as all of its pressures are computed). Rerunning
+with ``--resume`` then skips the points already saved, which also allows a
+completed calculation to be extended to new temperatures or pressures.
+
+Passing ``--profile FILE`` saves the wall time, number of calls, and size
+of the arrays allocated by each stage of the calculation (and at each 
+temperature and pressure), along with the peak resident memory of the 
+process, to ``FILE`` as JSON.
+
+Passing ``--converge TOL`` refines the energy grains, splitting each in two
+up to ``--refinements N`` times, until no rate coefficient changes by more
+than the relative tolerance ``TOL``; add ``--extrapolate`` to extrapolate
+the rate coefficients to zero grain size.
+
+If several files are given, or a directory (all of whose ``.py`` files are
+used), or a manifest ``@FILE`` listing one input file per line, the 
+networks are run in batch mode. Each is run in one of the ``-j`` worker 
+processes, its results are saved to a ``.npz`` file of the same name (in 
+the ``-o`` directory, if given), and a failure for one network does not 
+stop the others. The ``--checkpoint``, ``--profile``, ``--populations``, 
+and ``--fit`` options apply to a single network and cannot be used in 
+batch mode.
+
+Finally, ``--server`` runs MEASURE as a long-running service that reads 
+requests as JSON objects, one per line, from standard input (or from a Unix
+socket given by ``--socket PATH``) and writes the results as JSON, keeping
+its ``-j`` worker processes and densities of states cache resident between
+requests; see :mod:`measure.server` for the protocol. Each worker keeps at
+most ``--cache-size N`` densities of states in memory. Requests may only 
+name input and output files within the directory given by ``--root DIR``;
+without it, only inline inputs are accepted.
 """
 
 import argparse
@@ -52,8 +106,42 @@ def parseCommandLineArguments():
     """
 
     parser = argparse.ArgumentParser(description='Master Equation Automatic Solver for Unimolecular REactions.')
-    parser.add_argument('file', metavar='FILE', type=str, nargs=1,
-        help='a file containing information about the network')
+    parser.add_argument('file', metavar='FILE', type=str, nargs='*',
+        help='a file containing information about the network; several files, a directory of files, or a manifest @FILE listing files can be given to run in batch mode')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+        help='the number of worker processes to use (default is 1)')
+    parser.add_argument('--cache', metavar='DIR', type=str, default=None,
+        help='a directory in which to cache densities of states between runs')
+    parser.add_argument('--tolerance', metavar='TOL', type=float, default=1e-8,
+        help='the relative size below which collision matrix entries are neglected (default is 1e-8)')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, default=None,
+        help='a file in which to save the computed k(T,P) values (in batch mode, a directory in which to save them)')
+    parser.add_argument('--populations', action='store_true',
+        help='also save the population distributions to the output file')
+    parser.add_argument('--checkpoint', metavar='FILE', type=str, default=None,
+        help='a file in which to save each k(T,P) value as soon as it is computed')
+    parser.add_argument('--resume', action='store_true',
+        help='skip the points already saved in the checkpoint file')
+    parser.add_argument('--fit', action='store_true',
+        help='fit the computed k(T,P) values to Chebyshev polynomials and pressure-dependent Arrhenius expressions')
+    parser.add_argument('--chebyshev', metavar=('NT', 'NP'), type=int, nargs=2, default=[6, 4],
+        help='with --fit, the number of temperature and pressure terms in the Chebyshev fits (default is 6 4)')
+    parser.add_argument('--profile', metavar='FILE', type=str, default=None,
+        help='a file in which to save the time and memory used by each stage of the calculation')
+    parser.add_argument('--converge', metavar='TOL', type=float, default=None,
+        help='refine the energy grains until no k(T,P) value changes by more than this relative tolerance')
+    parser.add_argument('--refinements', metavar='N', type=int, default=3,
+        help='the maximum number of times to refine the energy grains with --converge (default is 3)')
+    parser.add_argument('--extrapolate', action='store_true',
+        help='with --converge, extrapolate the k(T,P) values to zero grain size')
+    parser.add_argument('--server', action='store_true',
+        help='run as a service, reading JSON requests from stdin (or the --socket) and writing JSON responses to stdout')
+    parser.add_argument('--socket', metavar='PATH', type=str, default=None,
+        help='in server mode, listen for requests on a Unix socket at this path')
+    parser.add_argument('--root', metavar='DIR', type=str, default=None,
+        help='in server mode, the directory within which requests may name input and output files (by default, only inline inputs are accepted)')
+    parser.add_argument('--cache-size', metavar='N', type=int, default=256,
+        help='in server mode, the maximum number of densities of states each worker keeps in memory (default is 256)')
     
     # Options for controlling the amount of information printed to the console
     # By default a moderate level of information is printed; you can either
@@ -62,7 +150,27 @@ def parseCommandLineArguments():
     group.add_argument('-q', '--quiet', action='store_true', help='only print warnings and errors')
     group.add_argument('-v', '--verbose', action='store_true', help='print more verbose output')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.socket is not None: args.server = True
+    if not args.server and len(args.file) == 0:
+        parser.error('at least one input file must be given')
+    if args.converge is not None and (args.checkpoint is not None or args.populations):
+        parser.error('--converge cannot be used with --checkpoint or --populations')
+    
+    # Determine the input files; if several were given (or a directory or
+    # a manifest of them), they are run in batch mode, which saves only the
+    # rate coefficients of each network
+    args.batch = False
+    if not args.server:
+        from measure.batch import getInputFiles
+        paths = getInputFiles(args.file)
+        args.batch = paths != args.file or len(paths) > 1
+        args.file = paths
+        if args.batch:
+            for option, value in [('--checkpoint', args.checkpoint), ('--profile', args.profile), ('--populations', args.populations), ('--fit', args.fit)]:
+                if value: parser.error('%s cannot be used with several input files' % option)
+    
+    return args
 
 ################################################################################
 
@@ -93,9 +201,13 @@ def initializeLogging(args):
     logger.setLevel(level)
 
     # Create console handler and set level to debug
-    # Also send everything to stdout rather than stderr
+    # Also send everything to stdout rather than stderr, unless stdout is
+    # being used to send responses in server mode
     import sys
-    ch = logging.StreamHandler(sys.stdout)
+    if getattr(args, 'server', False) and getattr(args, 'socket', None) is None:
+        ch = logging.StreamHandler(sys.stderr)
+    else:
+        ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(level)
 
     # Create formatter and add to console handler
@@ -140,25 +252,97 @@ if __name__ == '__main__':
     # Log header
     logHeader()
     
-    # Load input file
-    from measure.input import readInput
-    network, Tlist, Plist, Elist, method = readInput(args.file[0])
+    # In server mode, handle requests until stdin is closed or the service
+    # is interrupted
+    if args.server:
+        from measure.server import runServer
+        try:
+            runServer(workers=args.jobs, cacheDirectory=args.cache, socketPath=args.socket, rootDirectory=args.root, cacheSize=args.cache_size)
+        except KeyboardInterrupt:
+            logging.info('Server interrupted.')
+        network = None
+    else:
+        # If several input files were given, run them all in batch mode
+        if args.batch:
+            from measure.batch import runBatch, BatchError
+            try:
+                runBatch(args.file, args.output, workers=args.jobs, cacheDirectory=args.cache, collisionTolerance=args.tolerance, 
+                    converge=args.converge, maxRefinements=args.refinements, extrapolate=args.extrapolate)
+            except BatchError, e:
+                logging.error(str(e))
+            network = None
+        else:
+            # Load input file
+            from measure.input import readInput
+            network, Tlist, Plist, Elist, method = readInput(args.file[0])
     
     # Only proceed if the input network is valid
     if network is not None:
         
+        # Use the cache of densities of states, if one was specified
+        if args.cache is not None:
+            from measure.cache import StatesCache
+            network.statesCache = StatesCache(args.cache)
+        
         # Automatically choose a suitable set of energy grains if they were not
         # explicitly specified in the input file
-        if len(Elist) == 2:
+        if isinstance(Elist, tuple):
             logging.info('Automatically determining energy grains...')
             Tmax = max(Tlist)
-            grainSize, Ngrains = Elist
-            Elist = network.autoGenerateEnergyGrains(Tmax=Tmax, grainSize=grainSize, Ngrains=Ngrains)
-            logging.debug('Using %i energy grains from %g to %g kJ/mol in steps of %g kJ/mol' % (len(Elist), Elist[0] / 1000, Elist[-1] / 1000, (Elist[1] - Elist[0]) / 1000))
+            grainSize, Ngrains, maxGrainSize = Elist
+            Elist = network.autoGenerateEnergyGrains(Tmax=Tmax, grainSize=grainSize, Ngrains=Ngrains, maxGrainSize=maxGrainSize)
+            logging.debug('Using %i energy grains from %g to %g kJ/mol in steps of %g to %g kJ/mol' % (len(Elist), Elist[0] / 1000, Elist[-1] / 1000, (Elist[1:] - Elist[:-1]).min() / 1000, (Elist[1:] - Elist[:-1]).max() / 1000))
             logging.debug('')
         
-        # Calculate the rate coefficients
-        K = network.calculateRateCoefficients(Tlist, Plist, Elist, method)
+        # Save each completed point to the checkpoint file, if one was 
+        # specified, and skip those already saved there if resuming
+        checkpoint = None
+        if args.checkpoint is not None:
+            from measure.checkpoint import Checkpoint, getNetworkFingerprint
+            checkpoint = Checkpoint(args.checkpoint, getNetworkFingerprint(network, Elist, method, args.tolerance), resume=args.resume)
+        
+        # Record the time and memory used by each stage of the calculation,
+        # if a profile file was specified
+        profile = None
+        if args.profile is not None:
+            from measure.timing import Profiler
+            profile = Profiler()
+        
+        # Calculate the rate coefficients, refining the energy grains until
+        # they have converged if requested
+        pa = None
+        if args.converge is not None:
+            K, Elist = network.calculateConvergedRateCoefficients(Tlist, Plist, Elist, method, tolerance=args.converge, maxRefinements=args.refinements, extrapolate=args.extrapolate, workers=args.jobs, collisionTolerance=args.tolerance, profile=profile)
+        elif args.output is not None and args.populations:
+            K, pa = network.calculateRateCoefficients(Tlist, Plist, Elist, method, workers=args.jobs, collisionTolerance=args.tolerance, returnPopulations=True, checkpoint=checkpoint, profile=profile)
+        else:
+            K = network.calculateRateCoefficients(Tlist, Plist, Elist, method, workers=args.jobs, collisionTolerance=args.tolerance, checkpoint=checkpoint, profile=profile)
+        
+        if checkpoint is not None:
+            checkpoint.close()
+        
+        if profile is not None:
+            profile.close()
+            profile.log()
+            profile.save(args.profile)
+        
+        # Fit the rate coefficients of each net reaction to Chebyshev 
+        # polynomials and pressure-dependent Arrhenius expressions, if 
+        # requested; a failed fit is not fatal, since the rate coefficients
+        # themselves are still saved
+        fit = None
+        if args.fit:
+            from measure.fit import fitRateCoefficients, FitError
+            try:
+                fit = fitRateCoefficients(network, Tlist, Plist, K, degreeT=args.chebyshev[0], degreeP=args.chebyshev[1])
+            except FitError, e:
+                logging.warning('Unable to fit the rate coefficients: %s' % e)
+        
+        # Save the rate coefficients (and populations and fits) if an output
+        # file was specified
+        if args.output is not None:
+            from measure.output import saveResults
+            saveResults(args.output, Tlist, Plist, Elist, network.getConfigurationLabels(), K, pa, method, fit)
         
     # Log end timestamp
     logging.info('')
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains functions for running MEASURE on many networks in a single process,
+as when a mechanism generator produces a large number of small networks. The
+networks are distributed over a pool of worker processes, each of which keeps
+its imported modules and cache of densities of states between networks, and
+a failure for any one network is reported without stopping the others.
+"""
+
+import os
+import logging
+
+################################################################################
+
+class BatchError(Exception): 
+    """
+    An exception raised when running a batch of networks is unsuccessful for
+    any reason. Pass a string describing the cause of the exceptional 
+    behavior.
+    """
+    pass
+
+################################################################################
+
+def getInputFiles(paths):
+    """
+    Return the list of input files given by `paths`, each of which may be an
+    input file, a directory (in which case all of the ``.py`` files in it are
+    used), or the path of a manifest file prefixed with ``@``, which lists
+    one input file per line (blank lines and lines starting with ``#`` are 
+    ignored, and relative paths are relative to the manifest).
+    """
+    files = []
+    for path in paths:
+        if path.startswith('@'):
+            manifest = path[1:]
+            f = open(manifest, 'r')
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'): continue
+                    files.append(os.path.join(os.path.dirname(manifest), line))
+            finally:
+                f.close()
+        elif os.path.isdir(path):
+            files.extend([os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.py')])
+        else:
+            files.append(path)
+    return files
+
+def getOutputFile(path, outputDirectory=None):
+    """
+    Return the path of the results file for the input file at `path`: a 
+    ``.npz`` file of the same name, either alongside the input file or in
+    `outputDirectory` if given.
+    """
+    name = os.path.splitext(os.path.basename(path))[0] + '.npz'
+    return os.path.join(outputDirectory if outputDirectory is not None else os.path.dirname(path), name)
+
+def getOutputFiles(paths, outputDirectory=None):
+    """
+    Return the paths of the results files, as given by :func:`getOutputFile`,
+    for each of the input files `paths`. Raises a :class:`BatchError` if any
+    two input files would save their results to the same file, as when two
+    input files in different directories share a name and `outputDirectory`
+    is given.
+    """
+    outputPaths = [getOutputFile(path, outputDirectory) for path in paths]
+    inputs = {}
+    for path, outputPath in zip(paths, outputPaths):
+        key = os.path.normcase(os.path.abspath(outputPath))
+        if key in inputs:
+            raise BatchError('The input files "%s" and "%s" would both save their results to "%s".' % (inputs[key], path, outputPath))
+        inputs[key] = path
+    return outputPaths
+
+################################################################################
+
+def loadNetwork(path):
+    """
+    Read the network from the input file at `path`, returning the network,
+    the temperatures `Tlist` in K, the pressures `Plist` in Pa, the energy
+    grains `Elist` in J/mol (chosen automatically if the input file did not
+    specify them), and the method to use.
+    """
+    
+    from input import readInput
+    
+    result = readInput(path)
+    if result is None or result[0] is None:
+        raise BatchError('The input file "%s" could not be read.' % path)
+    network, Tlist, Plist, Elist, method = result
+    
+    # Automatically choose a suitable set of energy grains if they were not
+    # explicitly specified in the input file
+    if isinstance(Elist, tuple):
+        grainSize, Ngrains, maxGrainSize = Elist
+        Elist = network.autoGenerateEnergyGrains(Tmax=max(Tlist), grainSize=grainSize, Ngrains=Ngrains, maxGrainSize=maxGrainSize)
+    
+    return network, Tlist, Plist, Elist, method
+
+def runNetwork(path, outputPath, collisionTolerance=1e-8, statesCache=None, converge=None, maxRefinements=3, extrapolate=False):
+    """
+    Read the network from the input file at `path`, calculate its 
+    phenomenological rate coefficients, and save them to `outputPath`. The
+    given `collisionTolerance` and `statesCache` are used in the calculation.
+    If `converge` is given, the energy grains are refined up to 
+    `maxRefinements` times until the rate coefficients have converged to
+    that relative tolerance, and are extrapolated to zero grain size if 
+    `extrapolate` is ``True``, as in 
+    :meth:`Network.calculateConvergedRateCoefficients`.
+    """
+    
+    from output import saveResults
+    
+    network, Tlist, Plist, Elist, method = loadNetwork(path)
+    network.statesCache = statesCache
+    if converge is not None:
+        K, Elist = network.calculateConvergedRateCoefficients(Tlist, Plist, Elist, method, tolerance=converge, maxRefinements=maxRefinements, extrapolate=extrapolate, collisionTolerance=collisionTolerance)
+    else:
+        K = network.calculateRateCoefficients(Tlist, Plist, Elist, method, collisionTolerance=collisionTolerance)
+    saveResults(outputPath, Tlist, Plist, Elist, network.getConfigurationLabels(), K, method=method)
+
+def runBatch(paths, outputDirectory=None, workers=1, cacheDirectory=None, collisionTolerance=1e-8, converge=None, maxRefinements=3, extrapolate=False):
+    """
+    Run MEASURE for each of the input files `paths`, saving the results for
+    each to the file given by :func:`getOutputFile`; a :class:`BatchError` 
+    is raised before any network is run if two of them would save to the 
+    same file. The networks are run in a pool of `workers` processes, which
+    share the densities of states cache in `cacheDirectory` if one is given.
+    The remaining parameters are passed to :func:`runNetwork`. Returns a 
+    list containing, for each input file in turn, ``None`` if it succeeded 
+    or a string describing the error if it failed.
+    """
+    
+    outputPaths = getOutputFiles(paths, outputDirectory)
+    if outputDirectory is not None and not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    tasks = [(path, outputPath, collisionTolerance, converge, maxRefinements, extrapolate) for path, outputPath in zip(paths, outputPaths)]
+    
+    logging.info('Running %i networks using %i worker processes...' % (len(tasks), workers))
+    if workers > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(workers, len(tasks)), initializer=initializeBatchWorker, initargs=(cacheDirectory,))
+        try:
+            errors = pool.map(runNetworkWorker, tasks, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        initializeBatchWorker(cacheDirectory)
+        errors = [runNetworkWorker(task) for task in tasks]
+    
+    failures = [(path, error) for path, error in zip(paths, errors) if error is not None]
+    logging.info('Completed %i of %i networks successfully.' % (len(paths) - len(failures), len(paths)))
+    for path, error in failures:
+        logging.warning('Network "%s" failed: %s' % (path, error))
+    return errors
+
+################################################################################
+
+# The cache of densities of states used by each worker process
+workerStatesCache = None
+
+def initializeBatchWorker(cacheDirectory, cacheSize=256):
+    """
+    Create the densities of states cache used for every network run in a 
+    worker process, which keeps at most `cacheSize` arrays in memory. This
+    is called once when each worker process in the pool is started.
+    """
+    global workerStatesCache
+    from cache import StatesCache
+    workerStatesCache = StatesCache(cacheDirectory, cacheSize)
+
+def runNetworkWorker(task):
+    """
+    Run a single network in a worker process, where `task` is a tuple of 
+    the input file path, output file path, collision tolerance, and the
+    convergence tolerance, maximum number of refinements, and extrapolation
+    flag passed to :func:`runNetwork`. Returns ``None`` if successful, or a 
+    string describing the error if not.
+    """
+    path, outputPath, collisionTolerance, converge, maxRefinements, extrapolate = task
+    try:
+        runNetwork(path, outputPath, collisionTolerance, workerStatesCache, converge, maxRefinements, extrapolate)
+    except Exception, e:
+        logging.exception(e)
+        return '%s: %s' % (e.__class__.__name__, e)
+    return None
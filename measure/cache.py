@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains a cache for densities and sums of states, so that repeated 
+calculations involving the same species can skip the state counting. Each
+entry is identified by a hash of the parameters of the molecular degrees of
+freedom, the ground-state energy used to shift the states to a common zero of
+energy, and the energy grains.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+import numpy
+
+################################################################################
+
+def getStatesParameters(states):
+    """
+    Return a tuple containing the parameters of each of the molecular degrees
+    of freedom in the :class:`StatesModel` object `states`, suitable for
+    identifying that model in a cache key. Every public attribute of the
+    model and of each of its modes is included, along with the class name of
+    each mode, so that a change to any of them changes the key.
+    """
+    
+    def normalize(value):
+        if isinstance(value, (bool, int, long, basestring)) or value is None:
+            return value
+        elif isinstance(value, (float, numpy.number)):
+            return repr(float(value))
+        elif isinstance(value, numpy.ndarray):
+            return normalize(value.tolist())
+        elif isinstance(value, dict):
+            return tuple([(k, normalize(v)) for k, v in sorted(value.items())])
+        try:
+            return tuple([normalize(v) for v in value])
+        except TypeError:
+            # Any other object, such as a mode, is identified by its class
+            # and its public attributes
+            return (value.__class__.__name__, normalize(getPublicAttributes(value)))
+    
+    modes = tuple([normalize(mode) for mode in states.modes])
+    attributes = getPublicAttributes(states)
+    attributes.pop('modes', None)
+    return (modes, normalize(attributes))
+
+def getPublicAttributes(obj):
+    """
+    Return a dictionary of the attributes of the object `obj` whose names do
+    not begin with an underscore, other than its methods. Objects without a
+    ``__dict__`` (such as extension types) are inspected using :func:`dir`.
+    """
+    try:
+        names = vars(obj).keys()
+    except TypeError:
+        names = dir(obj)
+    attributes = {}
+    for name in names:
+        if name.startswith('_'): continue
+        value = getattr(obj, name)
+        if not callable(value): attributes[name] = value
+    return attributes
+
+################################################################################
+
+class StatesCache:
+    """
+    A content-addressed cache of densities and sums of states. The attributes
+    are:
+    
+    =============== =========== ================================================
+    Attribute       Type        Description
+    =============== =========== ================================================
+    `path`          ``str``     The directory in which the cached arrays are stored, or ``None`` to only cache in memory
+    `entries`       ``dict``    The arrays that have been loaded or computed most recently, indexed by key
+    `maxEntries`    ``int``     The maximum number of arrays to keep in `entries`, or ``None`` for no limit
+    =============== =========== ================================================
+    
+    Each array is stored in `path` as a ``.npy`` file named after its key, and
+    is loaded as a read-only memory-mapped array, so that many processes can 
+    share the same cache directory. Files are written atomically, so 
+    concurrent runs can safely populate the same cache. Once `entries` holds
+    `maxEntries` arrays, the least recently used one is dropped for each new
+    array added.
+    """
+    
+    def __init__(self, path=None, maxEntries=256):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if path is not None and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another process may have created the directory first
+                if not os.path.isdir(path): raise
+
+    def __getstate__(self):
+        """
+        Return the state of the cache for pickling. Only the path and the
+        maximum number of entries are kept, since the entries are reloaded 
+        from disk as needed.
+        """
+        return {'path': self.path, 'maxEntries': self.maxEntries}
+
+    def __setstate__(self, state):
+        """
+        Restore the state of the cache after unpickling.
+        """
+        self.__init__(state['path'], state.get('maxEntries', 256))
+
+    def getKey(self, kind, states, E0, Elist):
+        """
+        Return the key identifying the array of type `kind` (e.g. 
+        ``'densStates'``) for the list of :class:`StatesModel` objects `states`
+        (one per species in the configuration), shifted by the ground-state
+        energy `E0` in J/mol, and evaluated at the energy grains `Elist` in
+        J/mol.
+        """
+        grains = hashlib.sha1(numpy.ascontiguousarray(Elist, numpy.float64).tobytes()).hexdigest()
+        identifier = repr((kind, tuple([getStatesParameters(s) for s in states]), repr(float(E0)), len(Elist), grains))
+        return hashlib.sha1(identifier.encode('utf-8')).hexdigest()
+
+    def getArray(self, key, function):
+        """
+        Return the array cached with the given `key`. If it is not present in
+        the cache, `function` is called with no arguments to compute it, and 
+        the result is stored in the cache before being returned.
+        """
+        
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                # Move the entry to the end, as the most recently used
+                array = self.entries.pop(key)
+                self.entries[key] = array
+                return array
+        finally:
+            self.lock.release()
+        
+        array = None
+        if self.path is not None:
+            filename = os.path.join(self.path, key + '.npy')
+            if os.path.exists(filename):
+                array = numpy.load(filename, mmap_mode='r')
+        if array is None:
+            array = function()
+            if self.path is not None: self.save(filename, array)
+        
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = array
+            while self.maxEntries is not None and len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+        return array
+
+    def save(self, filename, array):
+        """
+        Save `array` to the file `filename`, first writing it to a temporary
+        file in the same directory and then renaming it, so that readers never
+        see a partially-written file.
+        """
+        fd, temp = tempfile.mkstemp(suffix='.npy', dir=self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                numpy.save(f, array)
+            finally:
+                f.close()
+            os.rename(temp, filename)
+        except:
+            if os.path.exists(temp): os.remove(temp)
+            raise
+
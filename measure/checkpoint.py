@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains a checkpoint file for long MEASURE calculations, in which the
+phenomenological rate coefficients :math:`k(T,P)` at each temperature and
+pressure are saved as soon as they are computed. An interrupted calculation
+can then be resumed, and a completed one extended to new temperatures or
+pressures, without recomputing the points already done. Each checkpoint is
+tagged with a fingerprint of the network, energy grains, and method, so that
+points computed for a different calculation are never reused.
+"""
+
+import os
+import hashlib
+import logging
+import numpy
+
+from cache import getStatesParameters
+
+################################################################################
+
+def getNetworkFingerprint(network, Elist, method, collisionTolerance=1e-8):
+    """
+    Return a string identifying the calculation of the rate coefficients of 
+    `network` using the energy grains `Elist` in J/mol, the given `method`,
+    and the collision tolerance `collisionTolerance`. Any change to the 
+    network that would change the rate coefficients changes the fingerprint.
+    """
+    
+    def getSpeciesParameters(species):
+        states = getattr(species, 'states', None)
+        lennardJones = getattr(species, 'lennardJones', None)
+        return (str(species), repr(getattr(species, 'E0', None)), 
+            repr(getattr(species, 'molecularWeight', None)),
+            getStatesParameters(states) if states is not None else None,
+            (repr(lennardJones.sigma), repr(lennardJones.epsilon)) if lennardJones is not None else None)
+    
+    def getReactionParameters(reaction):
+        kinetics = getattr(reaction, 'kinetics', None)
+        TS = reaction.transitionState
+        states = getattr(TS, 'states', None)
+        return (str(reaction), repr(TS.E0), getStatesParameters(states) if states is not None else None,
+            tuple([repr(getattr(kinetics, attr, None)) for attr in ['A', 'n', 'Ea']]) if kinetics is not None else None)
+    
+    collisionModel = network.collisionModel
+    identifier = (
+        method.lower(), repr(float(collisionTolerance)),
+        hashlib.sha1(numpy.ascontiguousarray(Elist, numpy.float64).tobytes()).hexdigest(),
+        tuple([getSpeciesParameters(isomer) for isomer in network.isomers]),
+        tuple([tuple([getSpeciesParameters(spec) for spec in configuration]) for configuration in network.reactants]),
+        tuple([tuple([getSpeciesParameters(spec) for spec in configuration]) for configuration in network.products]),
+        tuple([getReactionParameters(rxn) for rxn in network.pathReactions]),
+        getSpeciesParameters(network.bathGas),
+        (collisionModel.__class__.__name__, repr(getattr(collisionModel, 'alpha', None))),
+    )
+    return hashlib.sha1(repr(identifier).encode('utf-8')).hexdigest()
+
+################################################################################
+
+class Checkpoint:
+    """
+    A file in which the rate coefficients of a calculation are saved as each
+    point is completed. The attributes are:
+    
+    =============== =================== ========================================
+    Attribute       Type                Description
+    =============== =================== ========================================
+    `path`          ``str``             The path of the checkpoint file
+    `fingerprint`   ``str``             The fingerprint of the calculation, from :func:`getNetworkFingerprint`
+    `Tlist`         ``list``            The temperature in K of each completed point
+    `Plist`         ``list``            The pressure in Pa of each completed point
+    `K`             ``list``            The rate coefficient matrix of each completed point
+    =============== =================== ========================================
+    
+    If `resume` is ``True`` and the file already exists with the same 
+    fingerprint, the points it contains are loaded; otherwise it is started
+    afresh. Points are matched on temperature and pressure to a relative 
+    tolerance of 1e-9.
+    
+    The file consists of a header line containing the fingerprint, followed
+    by one record of ``float64`` values per point: the number of 
+    configurations, the temperature, the pressure, and the rate coefficient
+    matrix. Each point is appended to the file as it is saved, so the cost of
+    saving does not grow with the number of points already saved. A record
+    left partially written by an interruption is ignored when the file is 
+    loaded, and a point saved more than once takes the value saved last.
+    """
+    
+    def __init__(self, path, fingerprint, resume=False):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.Tlist = []
+        self.Plist = []
+        self.K = []
+        self.file = None
+        self.size = None
+        if resume and os.path.exists(path):
+            self.load()
+    
+    def getHeader(self):
+        """
+        Return the header line of the checkpoint file.
+        """
+        return ('MEASURE checkpoint %s\n' % self.fingerprint).encode('utf-8')
+    
+    def load(self):
+        """
+        Load the completed points from the checkpoint file, provided that it
+        was written for the same calculation.
+        """
+        f = open(self.path, 'rb')
+        try:
+            header = f.readline()
+            if header != self.getHeader():
+                logging.warning('Checkpoint file "%s" is for a different calculation, so it will not be used.' % self.path)
+                return
+            data = f.read()
+            data = numpy.frombuffer(data[0:len(data)-len(data)%8], numpy.float64)
+        finally:
+            f.close()
+        
+        # Read each complete record in turn
+        index = 0
+        while index < len(data):
+            if not 0 < data[index] < len(data): break
+            Nconf = int(data[index])
+            if index + 3 + Nconf * Nconf > len(data): break
+            self.addPoint(data[index+1], data[index+2], data[index+3:index+3+Nconf*Nconf].reshape(Nconf, Nconf))
+            index += 3 + Nconf * Nconf
+        
+        # Further points are appended after the last complete record
+        self.size = len(header) + 8 * index
+        logging.info('Loaded %i completed points from checkpoint file "%s".' % (len(self.K), self.path))
+    
+    def getIndex(self, T, P):
+        """
+        Return the index of the completed point at temperature `T` in K and
+        pressure `P` in Pa, or -1 if there is no such point.
+        """
+        for index in range(len(self.K)):
+            if abs(self.Tlist[index] - T) <= 1e-9 * T and abs(self.Plist[index] - P) <= 1e-9 * P:
+                return index
+        return -1
+    
+    def getRateCoefficients(self, T, P):
+        """
+        Return the rate coefficient matrix at temperature `T` in K and 
+        pressure `P` in Pa, or ``None`` if that point has not been completed.
+        """
+        index = self.getIndex(T, P)
+        return self.K[index] if index >= 0 else None
+    
+    def addPoint(self, T, P, K):
+        """
+        Add the rate coefficient matrix `K` at temperature `T` in K and 
+        pressure `P` in Pa to the completed points, replacing any existing
+        value at that point.
+        """
+        index = self.getIndex(T, P)
+        if index >= 0:
+            self.K[index] = numpy.array(K)
+        else:
+            self.Tlist.append(float(T)); self.Plist.append(float(P)); self.K.append(numpy.array(K))
+    
+    def save(self, T, Plist, K):
+        """
+        Add the rate coefficient matrices `K` computed at temperature `T` in K
+        and each of the pressures `Plist` in Pa to the checkpoint, and append
+        them to the checkpoint file. The file is started afresh on the first 
+        save unless its points were loaded.
+        """
+        if self.file is None:
+            if self.size is None:
+                self.file = open(self.path, 'wb')
+                self.file.write(self.getHeader())
+            else:
+                # Discard any partially-written record
+                self.file = open(self.path, 'r+b')
+                self.file.truncate(self.size)
+                self.file.seek(self.size)
+        
+        for P, Kp in zip(Plist, K):
+            self.addPoint(T, P, Kp)
+            Kp = numpy.asarray(Kp, numpy.float64)
+            record = numpy.concatenate([[Kp.shape[0], T, P], Kp.ravel()]).astype(numpy.float64)
+            self.file.write(record.tobytes())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    def close(self):
+        """
+        Close the checkpoint file.
+        """
+        if self.file is not None:
+            self.size = self.file.tell()
+            self.file.close()
+            self.file = None
@@ -35,9 +35,13 @@ that returns the value of :math:`P(E, E^\prime)` for that model.
 
 import math
 import numpy
+import scipy.linalg
+import logging
 
 import chempy.constants as constants
 
+import grains
+
 ################################################################################
 
 class CollisionError(Exception): 
@@ -92,18 +96,23 @@ def calculateCollisionEfficiency(species, T, Elist, densStates, collisionModel,
     if Ereac - E0 < 100000:
         Ereac = E0 + 100000
 
-    Ngrains = len(Elist)
-    dE = Elist[1] - Elist[0]
-    FeNum = 0; FeDen = 0
-    Delta1 = 0; Delta2 = 0; DeltaN = 0; Delta = 1
-
-    for r in range(Ngrains):
-        value = densStates[r] * math.exp(-Elist[r] / constants.R / T)
-        if Elist[r] > Ereac:
-            FeNum += value * dE
-            if FeDen == 0:
-                FeDen = value * constants.R * T
-    if FeDen == 0: return 1.0
+    dE = grains.getGrainWidths(Elist)
+    value = densStates * numpy.exp(-Elist / constants.R / T)
+    active = Elist > Ereac
+    
+    # The densities of states already include the width of each grain, so
+    # for energy grains that are not evenly spaced the integrals below are 
+    # plain sums, and the width is divided out where a density per unit 
+    # energy is needed
+    densityValue = value
+    if not numpy.isscalar(dE):
+        densityValue = value / dE
+        dE = 1.0
+    
+    FeNum = numpy.sum(value[active]) * dE
+    FeDen = densityValue[active & (value != 0)]
+    if len(FeDen) == 0: return 1.0
+    FeDen = FeDen[0] * constants.R * T
     Fe = FeNum / FeDen
 
     # Chang, Bozzelli, and Dean recommend "freezing out" Fe at values greater
@@ -112,13 +121,11 @@ def calculateCollisionEfficiency(species, T, Elist, densStates, collisionModel,
     # in this regime, so it's an okay approximation to use
     if Fe > 1e6: Fe = 1e6
     
-    for r in range(Ngrains):
-        value = densStates[r] * math.exp(-Elist[r] / constants.R / T)
-        # Delta
-        if Elist[r] < Ereac:
-            Delta1 += value * dE
-            Delta2 += value * dE * math.exp(-(Ereac - Elist[r]) / (Fe * constants.R * T))
-        DeltaN += value * dE
+    # Delta
+    inactive = Elist < Ereac
+    Delta1 = numpy.sum(value[inactive]) * dE
+    Delta2 = numpy.sum(value[inactive] * numpy.exp(-(Ereac - Elist[inactive]) / (Fe * constants.R * T))) * dE
+    DeltaN = numpy.sum(value) * dE
 
     Delta1 /= DeltaN
     Delta2 /= DeltaN
@@ -144,6 +151,88 @@ class CollisionModel:
 
 ################################################################################
 
+class BandedCollisionMatrix:
+    """
+    A collision matrix stored in banded form, such that only the entries 
+    within a certain number of grains of the diagonal are kept. The attributes
+    are:
+    
+    =============== =================== ========================================
+    Attribute       Type                Description
+    =============== =================== ========================================
+    `data`          ``numpy.ndarray``   The entries within the band, stored such that ``data[halfbandwidth+r-s,s]`` is the entry in row `r` and column `s`
+    `halfbandwidth` ``int``             The number of grains on each side of the diagonal that are in the band
+    =============== =================== ========================================
+    
+    The layout of `data` is the one used by :func:`scipy.linalg.solve_banded`.
+    Multiplying a banded collision matrix by a scalar (e.g. a collision 
+    frequency) returns a new banded collision matrix.
+    """
+    
+    def __init__(self, data, halfbandwidth):
+        self.data = data
+        self.halfbandwidth = halfbandwidth
+    
+    def __mul__(self, factor):
+        return BandedCollisionMatrix(self.data * factor, self.halfbandwidth)
+    
+    __rmul__ = __mul__
+    
+    def getNumberOfGrains(self):
+        """
+        Return the number of energy grains (i.e. the number of rows and columns)
+        in the collision matrix.
+        """
+        return self.data.shape[1]
+    
+    def getHalfbandwidth(self, tol=0.0):
+        """
+        Return the smallest half-bandwidth outside of which every entry of the
+        collision matrix is no larger than `tol` times the magnitude of the
+        diagonal entry in its column. This can be smaller than the
+        `halfbandwidth` attribute, which is only an upper bound.
+        """
+        h = self.halfbandwidth
+        large = numpy.abs(self.data) > tol * numpy.abs(self.data[h,:])
+        offsets = numpy.abs(numpy.arange(2 * h + 1) - h)[numpy.any(large, axis=1)]
+        return int(offsets.max()) if len(offsets) > 0 else 0
+    
+    def tosparse(self):
+        """
+        Return the collision matrix as a :class:`scipy.sparse.dia_matrix`.
+        """
+        import scipy.sparse
+        Ngrains = self.getNumberOfGrains()
+        offsets = self.halfbandwidth - numpy.arange(2 * self.halfbandwidth + 1)
+        return scipy.sparse.dia_matrix((self.data, offsets), shape=(Ngrains,Ngrains))
+    
+    def toarray(self):
+        """
+        Return the collision matrix as a dense array, with the entries outside
+        the band set to zero.
+        """
+        return self.tosparse().toarray()
+    
+    def dot(self, x):
+        """
+        Return the product of the collision matrix with the vector (or the 
+        columns of the matrix) `x`.
+        """
+        Ngrains = self.getNumberOfGrains()
+        h = self.halfbandwidth
+        x = numpy.asarray(x)
+        y = numpy.zeros(x.shape, numpy.float64)
+        # Add the contribution of each diagonal of the band in turn
+        for k in range(2 * h + 1):
+            offset = h - k
+            if offset >= 0:
+                y[0:Ngrains-offset] += (self.data[k,offset:] * x[offset:].T).T
+            else:
+                y[-offset:] += (self.data[k,0:Ngrains+offset] * x[0:Ngrains+offset].T).T
+        return y
+
+################################################################################
+
 class SingleExponentialDownModel(CollisionModel):
     """
     A single exponential down collision model, based around the collisional 
@@ -175,16 +264,24 @@ class SingleExponentialDownModel(CollisionModel):
         Ngrains = len(Elist)
         P = numpy.zeros((Ngrains,Ngrains), numpy.float64)
         
-        start = -1
-        for i in range(Ngrains):
-            if densStates[i] > 0 and start == -1:
-                start = i
-                break
+        nonzero = numpy.flatnonzero(densStates > 0)
+        if len(nonzero) == 0: return P
+        start = nonzero[0]
+        N = Ngrains - start
         
         # Determine unnormalized entries in collisional transfer probability matrix
-        for r in range(start, Ngrains):
-            P[0:r+1,r] = numpy.exp(-(Elist[r] - Elist[0:r+1]) / self.alpha)
-            P[r+1:,r] = numpy.exp(-(Elist[r+1:] - Elist[r]) / self.alpha) * densStates[r+1:] / densStates[r] * numpy.exp(-(Elist[r+1:] - Elist[r]) / (constants.R * T))
+        # Column r contains the transitions out of grain r; the deactivating
+        # entries on and above the diagonal are exp(-(E_r - E_s) / alpha), and
+        # the activating entries below the diagonal follow from detailed balance
+        # All of the entries are formed at once by evaluating their exponents
+        below = numpy.tri(N, N, -1, dtype=bool)
+        logDensStates = numpy.log(densStates[start:])
+        X = numpy.abs(Elist.reshape(-1,1) - Elist[start:].reshape(1,-1))
+        X[0:start,:] *= -1.0 / self.alpha
+        X[start:,:] *= numpy.where(below, -1.0 / self.alpha - 1.0 / (constants.R * T), -1.0 / self.alpha)
+        X[start:,:] += numpy.where(below, logDensStates.reshape(-1,1) - logDensStates.reshape(1,-1), 0.0)
+        P[:,start:] = numpy.exp(X)
+        U = P[start:,start:]
         
         # Normalize using detailed balance
         # This method is much more robust, and corresponds to:
@@ -192,26 +289,85 @@ class SingleExponentialDownModel(CollisionModel):
         #    [ 1 2 2 2 ...]
         #    [ 1 2 3 3 ...]
         #    [ 1 2 3 4 ...]
-        for r in range(start, Ngrains):
-            C = (1 - numpy.sum(P[start:r,r])) / numpy.sum(P[r:Ngrains,r])
-            # Check for normalization consistency (i.e. all numbers are positive)
-            if C < 0: raise ChemPyError('Encountered negative normalization coefficient while normalizing collisional transfer probabilities matrix.')
-            P[r,r+1:Ngrains] *= C
-            P[r:Ngrains,r] *= C
-            P[r,r] -= 1
-        # This method is described by Pilling and Holbrook, and corresponds to:
-        #    [ ... 4 3 2 1 ]
-        #    [ ... 3 3 2 1 ]
-        #    [ ... 2 2 2 1 ]
-        #    [ ... 1 1 1 1 ]
-        #for r in range(Ngrains, start, -1):
-            #C = (1 - numpy.sum(M[r:Ngrains,r])) / numpy.sum(M[0:r,r])
-            ## Check for normalization consistency (i.e. all numbers are positive)
-            #if C < 0: raise ChemPyError('Encountered negative normalization coefficient while normalizing collisional transfer probabilities matrix.')
-            #P[r,0:r-1] *= C
-            #P[0:r,r] *= C
-            #P[r,r] -= 1
+        # (Pilling and Holbrook describe the reverse ordering, starting from 
+        # the highest grain, but it is less robust.)
+        # The normalization coefficient C[r] for grain r satisfies
+        #    sum(C[s] * P[s,r] for s < r) + C[r] * sum(P[s,r] for s >= r) = 1
+        # which is a triangular system in the upper triangle of P, so we solve
+        # it in place after temporarily replacing the (unit) diagonal
+        U[numpy.diag_indices(N)] = numpy.sum(numpy.where(below, U, 0.0), axis=0) + 1.0
+        C = scipy.linalg.solve_triangular(U, numpy.ones(N), trans='T', lower=False)
+        # Check for normalization consistency (i.e. all numbers are positive)
+        if (C < 0).any(): raise CollisionError('Encountered negative normalization coefficient while normalizing collisional transfer probabilities matrix.')
+        # Entries above the diagonal are scaled by the coefficient of their
+        # row, and those on and below the diagonal by that of their column
+        U *= numpy.where(below, C.reshape(1,-1), C.reshape(-1,1))
+        U[numpy.diag_indices(N)] = C - 1
 
         return P
 
+    def generateBandedCollisionMatrix(self, Elist, T, densStates, tol=1e-8):
+        """
+        Generate and return the collisional transfer probability matrix 
+        :math:`P(E, E^\prime)` for this model as a 
+        :class:`BandedCollisionMatrix` for a given set of energies `Elist` in
+        J/mol, temperature `T` in K, and isomer density of states `densStates`.
+        Only the band of the matrix outside of which all entries are smaller 
+        than `tol` times the diagonal entry of their column is computed and 
+        stored.
+        """
+        Ngrains = len(Elist)
+        
+        nonzero = numpy.flatnonzero(densStates > 0)
+        if len(nonzero) == 0: 
+            return BandedCollisionMatrix(numpy.zeros((1,Ngrains), numpy.float64), 0)
+        start = nonzero[0]
+        N = Ngrains - start
+        
+        # The deactivating entries decay as exp(-(E_r - E_s) / alpha), which
+        # gives an initial estimate of the half-bandwidth; the band is widened
+        # if the entries at its edges turn out to be too large
+        dE = (Elist[-1] - Elist[0]) / (Ngrains - 1)
+        halfbandwidth = min(Ngrains - 1, int(math.ceil(-self.alpha * math.log(tol) / dE)) + 1)
+        
+        while True:
+            
+            # Row and column indices of each entry in the band
+            offset = numpy.arange(-halfbandwidth, halfbandwidth+1).reshape(-1,1)
+            s = numpy.zeros((2*halfbandwidth+1,1), numpy.int64) + numpy.arange(Ngrains)
+            r = s + offset
+            valid = (r >= 0) & (r < Ngrains) & (s >= start)
+            r[r < 0] = 0; r[r >= Ngrains] = Ngrains - 1
+            below = valid & (offset > 0)
+            
+            # Determine unnormalized entries in the band, exactly as in 
+            # generateCollisionMatrix()
+            X = numpy.abs(Elist[r] - Elist[s])
+            X *= numpy.where(below, -1.0 / self.alpha - 1.0 / (constants.R * T), -1.0 / self.alpha)
+            data = numpy.where(valid, numpy.exp(X), 0.0)
+            data[below] *= densStates[r[below]] / densStates[s[below]]
+            
+            # Normalize using detailed balance, as in generateCollisionMatrix()
+            # The triangular system for the normalization coefficients is 
+            # itself banded, with the deactivating entries as its subdiagonals
+            ab = numpy.zeros((halfbandwidth+1,N), numpy.float64)
+            ab[0,:] = numpy.sum(data[halfbandwidth:,start:], axis=0)
+            for m in range(1, min(halfbandwidth+1, N)):
+                ab[m,0:N-m] = data[halfbandwidth-m,start+m:]
+            C = scipy.linalg.solve_banded((halfbandwidth,0), ab, numpy.ones(N))
+            # Check for normalization consistency (i.e. all numbers are positive)
+            if (C < 0).any(): raise CollisionError('Encountered negative normalization coefficient while normalizing collisional transfer probabilities matrix.')
+            # Entries above the diagonal are scaled by the coefficient of their
+            # row, and those on and below the diagonal by that of their column
+            Cfull = numpy.ones(Ngrains, numpy.float64)
+            Cfull[start:] = C
+            data *= numpy.where(offset < 0, Cfull[r], Cfull[s])
+            data[halfbandwidth,start:] -= 1
+            
+            # Stop once the entries at the edges of the band are negligible
+            edges = numpy.maximum(numpy.abs(data[0,:]), numpy.abs(data[-1,:]))
+            if halfbandwidth >= Ngrains - 1 or (edges <= tol * numpy.abs(data[halfbandwidth,:])).all():
+                return BandedCollisionMatrix(data, halfbandwidth)
+            halfbandwidth = min(Ngrains - 1, 2 * halfbandwidth)
+
 ################################################################################
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+This module provides an implementation of the chemically-significant 
+eigenvalues method for reducing a master equation model of unimolecular 
+reaction networks to a set of phenomenological rate coefficients 
+:math:`k(T,P)`.
+"""
+
+import logging
+import numpy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+import chempy.constants as constants
+
+################################################################################
+
+class ChemicallySignificantEigenvaluesError(Exception): 
+    """
+    An exception raised when the chemically-significant eigenvalues method is
+    unsuccessful for any reason. Pass a string describing the cause of the 
+    exceptional behavior.
+    """
+    pass
+
+################################################################################
+
+def applyChemicallySignificantEigenvaluesMethod(T, P, Elist, densStates, Mcoll, 
+  Kij, Fim, Gnj, eqRatios, Nisom, Nreac, Nprod):
+    """
+    Use the chemically-significant eigenvalues method to reduce the master
+    equation model to a set of phenomenological rate coefficients 
+    :math:`k(T,P)` and a set of eigenmode population vectors. Inputs are the
+    temperature `T` in K; pressure `P` in Pa; list of energy grains `Elist` in
+    J/mol; dimensionless densities of states for each isomer and reactant 
+    channel `densStates`; a list of collision matrices `Mcoll`, one per 
+    isomer, each a :class:`BandedCollisionMatrix`; isomerization, association,
+    and dissociation microcanonical rate coefficients `Kij`, `Fim`, and `Gnj`,
+    respectively; the equilibrium ratios (partition functions) of each isomer
+    and reactant channel `eqRatios`; and the numbers of isomers, reactant 
+    channels, and product channels `Nisom`, `Nreac`, and `Nprod`, 
+    respectively. 
+    
+    The full master equation matrix is symmetrized using the equilibrium
+    populations, and only its ``Nisom+Nreac`` least negative eigenvalues and
+    the corresponding eigenvectors are computed, using a shift-invert sparse
+    eigensolver. The returned populations have shape 
+    ``(Ngrains, Nisom, Nisom+Nreac)``, and contain the isomer populations of
+    each chemically-significant eigenmode.
+    """
+    
+    Ngrains = len(Elist)
+    Nchem = Nisom + Nreac
+    
+    # Assign a row of the master equation matrix to each isomer grain with a
+    # nonzero density of states, interleaving the isomers grain by grain to
+    # keep the matrix banded, followed by a row for each reactant channel
+    active = (densStates[0:Nisom,:] > 0).T
+    indices = -numpy.ones((Ngrains,Nisom), numpy.int64)
+    indices[active] = numpy.arange(numpy.sum(active))
+    Ngrain = numpy.sum(active)
+    Nrows = Ngrain + Nreac
+    r, i = numpy.nonzero(active)
+    rows = indices[r,i]
+    
+    # Equilibrium distributions and populations, used to symmetrize
+    eqDist = densStates * numpy.exp(-Elist / constants.R / T)
+    eqPop = numpy.zeros(Nrows, numpy.float64)
+    eqPop[rows] = eqRatios[i] * eqDist[i,r]
+    eqPop[Ngrain:] = eqRatios[Nisom:]
+    
+    # Assemble the full master equation matrix as a list of entries
+    M_row = []; M_col = []; M_data = []
+    def addEntries(row, col, data):
+        M_row.append(row); M_col.append(col); M_data.append(data)
+    
+    # Collisional terms between active grains of the same isomer
+    for j in range(Nisom):
+        C = Mcoll[j].tosparse().tocoo()
+        keep = (indices[C.row,j] >= 0) & (indices[C.col,j] >= 0)
+        addEntries(indices[C.row[keep],j], indices[C.col[keep],j], C.data[keep])
+    # Isomerization terms
+    Kact = Kij[:,:,:].copy()
+    for j in range(Nisom):
+        Kact[j,j,:] = 0
+    for j in range(Nisom):
+        for k in range(Nisom):
+            both = active[:,j] & active[:,k] & (Kact[j,k,:] != 0)
+            addEntries(indices[both,j], indices[both,k], Kact[j,k,both])
+    # Loss terms due to isomerization and dissociation
+    addEntries(rows, rows, -numpy.sum(Kact[:,i,r], axis=0) - numpy.sum(Gnj[:,i,r], axis=0))
+    # Association and dissociation terms
+    for n in range(Nreac):
+        addEntries(numpy.ones_like(rows) * (Ngrain + n), rows, Gnj[n,i,r])
+        addEntries(rows, numpy.ones_like(rows) * (Ngrain + n), Fim[i,n,r] * eqDist[Nisom+n,r])
+        addEntries(numpy.array([Ngrain + n]), numpy.array([Ngrain + n]), numpy.array([-numpy.sum(Fim[:,n,:] * eqDist[Nisom+n,:])]))
+    
+    M_row = numpy.concatenate(M_row); M_col = numpy.concatenate(M_col); M_data = numpy.concatenate(M_data)
+    
+    # Symmetrize the matrix using the equilibrium populations, i.e. form
+    # S^-1 M S with S = diag(sqrt(eqPop)), which is symmetric by detailed
+    # balance; the average with its transpose removes any roundoff asymmetry
+    S = numpy.sqrt(eqPop)
+    M = scipy.sparse.coo_matrix((M_data * S[M_col] / S[M_row], (M_row, M_col)), shape=(Nrows,Nrows)).tocsc()
+    M = (M + M.T) * 0.5
+    
+    # Compute the least negative eigenvalues and their eigenvectors
+    # We also compute the next eigenvalue (the first internal energy
+    # relaxation eigenvalue) to check that the chemically-significant 
+    # eigenvalues are well separated from the others
+    Neig = min(Nchem + 1, Nrows)
+    if Nrows <= 2 * Neig + 1:
+        # Too small for the iterative solver, so just diagonalize directly
+        eigval, eigvec = scipy.linalg.eigh(M.toarray())
+        eigval = eigval[::-1][0:Neig]; eigvec = eigvec[:,::-1][:,0:Neig]
+    else:
+        # All eigenvalues are non-positive, so a small positive shift picks out
+        # those closest to zero, while keeping the shifted matrix nonsingular
+        sigma = 1e-9 * numpy.max(numpy.abs(M.diagonal()))
+        eigval, eigvec = scipy.sparse.linalg.eigsh(M, k=Neig, sigma=sigma, which='LM')
+        order = numpy.argsort(eigval)[::-1]
+        eigval = eigval[order]; eigvec = eigvec[:,order]
+    
+    logging.debug('Chemically-significant eigenvalues: %s' % (eigval[0:Nchem]))
+    if Neig > Nchem:
+        logging.debug('First internal energy relaxation eigenvalue: %s' % (eigval[Nchem]))
+        if abs(eigval[Nchem-1]) > 0.1 * abs(eigval[Nchem]):
+            logging.warning('Chemically-significant eigenvalues at %g K, %g bar are not well separated from the internal energy relaxation eigenvalues.' % (T, P/1e5))
+    eigval = eigval[0:Nchem]; eigvec = eigvec[:,0:Nchem]
+    
+    # Unsymmetrize the eigenvectors to obtain the populations of each mode
+    pop = eigvec * S.reshape(-1,1)
+    
+    # Total population of each isomer, reactant, and product in each mode
+    X = numpy.zeros((Nchem,Nchem), numpy.float64)
+    for j in range(Nisom):
+        X[j,:] = numpy.sum(pop[indices[active[:,j],j],:], axis=0)
+    X[Nisom:,:] = pop[Ngrain:,:]
+    Y = numpy.zeros((Nprod,Nchem), numpy.float64)
+    for n in range(Nprod):
+        Y[n,:] = numpy.dot(Gnj[Nreac+n,i,r], pop[rows,:])
+    
+    # Determine the phenomenological rate coefficients
+    try:
+        Xinv = numpy.linalg.inv(X)
+    except numpy.linalg.LinAlgError:
+        raise ChemicallySignificantEigenvaluesError('Unable to invert the matrix of chemically-significant eigenvector populations.')
+    K = numpy.zeros((Nisom+Nreac+Nprod, Nisom+Nreac+Nprod), numpy.float64)
+    K[0:Nchem,0:Nchem] = numpy.dot(X * eigval, Xinv)
+    K[Nchem:,0:Nchem] = numpy.dot(Y, Xinv)
+    
+    # Populations of the isomers in each chemically-significant eigenmode
+    pa = numpy.zeros((Ngrains,Nisom,Nchem), numpy.float64)
+    pa[r,i,:] = pop[rows,:]
+    
+    return K, pa
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains functions for fitting the phenomenological rate coefficients
+:math:`k(T,P)` computed by MEASURE to compact forms suitable for use in 
+kinetics models: Chebyshev polynomials and pressure-dependent Arrhenius 
+(PLOG) expressions. The fits for all of the net reactions in a network are
+determined together by a single linear least-squares solve.
+"""
+
+import math
+import numpy
+import logging
+
+import chempy.constants as constants
+
+################################################################################
+
+class FitError(Exception): 
+    """
+    An exception raised when fitting rate coefficients is unsuccessful for
+    any reason. Pass a string describing the cause of the exceptional behavior.
+    """
+    pass
+
+################################################################################
+
+def getNetReactions(K, Nisom, Nreac):
+    """
+    Return the indices of the products and reactants, as two arrays, of the
+    net reactions in the array of phenomenological rate coefficients `K`, 
+    whose last two indices are those of the product and reactant 
+    configurations, respectively. The net reactions are those from an isomer
+    or reactant channel to any other configuration, for which the rate 
+    coefficient is positive at every temperature and pressure.
+    """
+    positive = numpy.all((K > 0).reshape(-1, K.shape[-2], K.shape[-1]), axis=0)
+    positive[:,Nisom+Nreac:] = False
+    positive[range(len(positive)),range(len(positive))] = False
+    return numpy.nonzero(positive)
+
+################################################################################
+
+def getReducedTemperatures(Tlist, Tmin, Tmax):
+    """
+    Return the reduced temperatures, in the range [-1, 1], corresponding to
+    the temperatures `Tlist` in K for a Chebyshev fit over the range `Tmin`
+    to `Tmax` in K.
+    """
+    Tlist = numpy.asarray(Tlist, numpy.float64)
+    # A fit at a single temperature is constant in temperature
+    if Tmin == Tmax: return numpy.zeros_like(Tlist)
+    return (2.0 / Tlist - 1.0 / Tmin - 1.0 / Tmax) / (1.0 / Tmax - 1.0 / Tmin)
+
+def getReducedPressures(Plist, Pmin, Pmax):
+    """
+    Return the reduced pressures, in the range [-1, 1], corresponding to
+    the pressures `Plist` in Pa for a Chebyshev fit over the range `Pmin`
+    to `Pmax` in Pa.
+    """
+    Plist = numpy.asarray(Plist, numpy.float64)
+    # A fit at a single pressure is constant in pressure
+    if Pmin == Pmax: return numpy.zeros_like(Plist)
+    return (2.0 * numpy.log(Plist) - math.log(Pmin) - math.log(Pmax)) / (math.log(Pmax) - math.log(Pmin))
+
+def getChebyshevPolynomials(x, degree):
+    """
+    Return the values of the first `degree` Chebyshev polynomials of the 
+    first kind at each of the reduced values `x`, as an array with one row
+    per value.
+    """
+    x = numpy.clip(numpy.asarray(x, numpy.float64), -1.0, 1.0)
+    return numpy.cos(numpy.outer(numpy.arccos(x), numpy.arange(degree)))
+
+def fitChebyshev(Tlist, Plist, klist, degreeT, degreeP, Tmin=None, Tmax=None, Pmin=None, Pmax=None):
+    """
+    Fit the rate coefficients `klist`, an array of shape ``(NT, NP, Nrxn)`` 
+    containing the values for each of `Nrxn` reactions at the temperatures
+    `Tlist` in K and pressures `Plist` in Pa, to Chebyshev polynomials of 
+    `degreeT` terms in reduced inverse temperature and `degreeP` terms in
+    reduced logarithmic pressure, such that
+    
+    .. math:: \\log_{10} k(T,P) = \\sum_{t=1}^{N_T} \\sum_{p=1}^{N_P} \\alpha_{tp} \\phi_t(\\tilde{T}) \\phi_p(\\tilde{P})
+    
+    The ranges of the fit default to those of `Tlist` and `Plist`. Returns 
+    the coefficients as an array of shape ``(Nrxn, degreeT, degreeP)`` and 
+    the maximum relative error of each fit at the fitted points, in percent.
+    """
+    
+    NT = len(Tlist); NP = len(Plist); Nrxn = klist.shape[2]
+    if degreeT > NT or degreeP > NP:
+        raise FitError('Cannot fit Chebyshev polynomials of degree %i x %i to only %i temperatures and %i pressures.' % (degreeT, degreeP, NT, NP))
+    if Tmin is None: Tmin = min(Tlist)
+    if Tmax is None: Tmax = max(Tlist)
+    if Pmin is None: Pmin = min(Plist)
+    if Pmax is None: Pmax = max(Plist)
+    
+    # Each row of the least-squares matrix corresponds to one (T, P) point
+    # and each column to one product of polynomials
+    phiT = getChebyshevPolynomials(getReducedTemperatures(Tlist, Tmin, Tmax), degreeT)
+    phiP = getChebyshevPolynomials(getReducedPressures(Plist, Pmin, Pmax), degreeP)
+    A = numpy.einsum('it,jp->ijtp', phiT, phiP).reshape(NT*NP, degreeT*degreeP)
+    b = numpy.log10(klist).reshape(NT*NP, Nrxn)
+    
+    coeffs = numpy.linalg.lstsq(A, b, rcond=-1)[0]
+    error = 100.0 * (10**numpy.max(numpy.abs(numpy.dot(A, coeffs) - b), axis=0) - 1)
+    
+    return coeffs.T.reshape(Nrxn, degreeT, degreeP), error
+
+def evaluateChebyshev(coeffs, T, P, Tmin, Tmax, Pmin, Pmax):
+    """
+    Return the rate coefficients at temperature `T` in K and pressure `P` in
+    Pa of each of the Chebyshev fits with coefficients `coeffs` over the 
+    range `Tmin` to `Tmax` in K and `Pmin` to `Pmax` in Pa.
+    """
+    phiT = getChebyshevPolynomials([getReducedTemperatures(T, Tmin, Tmax)], coeffs.shape[1])[0]
+    phiP = getChebyshevPolynomials([getReducedPressures(P, Pmin, Pmax)], coeffs.shape[2])[0]
+    return 10**numpy.einsum('ntp,t,p->n', coeffs, phiT, phiP)
+
+################################################################################
+
+def fitPDepArrhenius(Tlist, Plist, klist):
+    """
+    Fit the rate coefficients `klist`, an array of shape ``(NT, NP, Nrxn)`` 
+    containing the values for each of `Nrxn` reactions at the temperatures
+    `Tlist` in K and pressures `Plist` in Pa, to a modified Arrhenius 
+    expression
+    
+    .. math:: k(T) = A T^n \\exp \\left( - \\frac{E_\\mathrm{a}}{RT} \\right)
+    
+    at each pressure, as used in pressure-dependent Arrhenius (PLOG) 
+    expressions. Fewer parameters are fitted if there are fewer than three
+    temperatures. Returns the preexponential factors `A`, temperature 
+    exponents `n`, and activation energies `Ea` in J/mol, each as an array of
+    shape ``(NP, Nrxn)``, and the maximum relative error of each fit at the
+    fitted points, in percent.
+    """
+    
+    NT = len(Tlist); NP = len(Plist); Nrxn = klist.shape[2]
+    Tlist = numpy.asarray(Tlist, numpy.float64)
+    
+    # Each row of the least-squares matrix corresponds to one temperature,
+    # and the fits at every pressure are done together
+    A = numpy.array([numpy.ones(NT), -1.0 / constants.R / Tlist, numpy.log(Tlist)]).T[:,0:min(3,NT)]
+    b = numpy.log(klist).reshape(NT, NP*Nrxn)
+    
+    params = numpy.zeros((3, NP*Nrxn), numpy.float64)
+    params[0:A.shape[1],:] = numpy.linalg.lstsq(A, b, rcond=-1)[0]
+    residual = numpy.abs(numpy.dot(A, params[0:A.shape[1],:]) - b).reshape(NT, NP, Nrxn)
+    error = 100.0 * (numpy.exp(numpy.max(residual, axis=(0,1))) - 1)
+    
+    params = params.reshape(3, NP, Nrxn)
+    return numpy.exp(params[0]), params[2], params[1], error
+
+def evaluatePDepArrhenius(Plist, A, n, Ea, T, P):
+    """
+    Return the rate coefficients at temperature `T` in K and pressure `P` in
+    Pa of each of the pressure-dependent Arrhenius fits with parameters `A`,
+    `n`, and `Ea` (in J/mol) at the pressures `Plist` in Pa. The logarithm of
+    the rate coefficient is interpolated linearly in the logarithm of 
+    pressure between the fitted pressures.
+    """
+    logk = numpy.log(A) + n * math.log(T) - Ea / constants.R / T
+    logP = numpy.log(Plist)
+    return numpy.exp([numpy.interp(math.log(P), logP, logk[:,j]) for j in range(logk.shape[1])])
+
+################################################################################
+
+def fitRateCoefficients(network, Tlist, Plist, K, degreeT=6, degreeP=4):
+    """
+    Fit the phenomenological rate coefficients `K` computed for the given
+    `network` at temperatures `Tlist` in K and pressures `Plist` in Pa to
+    both Chebyshev polynomials (of up to `degreeT` by `degreeP` terms) and 
+    pressure-dependent Arrhenius expressions, for every net reaction, and log
+    the errors and parameters of the fits. The numbers of Chebyshev terms 
+    are reduced to the numbers of temperatures and pressures if there are 
+    fewer of them. Returns the indices of the products and reactants of the
+    net reactions, a tuple of the Chebyshev coefficients and errors, and a 
+    tuple of the pressure-dependent Arrhenius parameters and errors.
+    """
+    
+    Nisom = len(network.isomers)
+    Nreac = len(network.reactants)
+    labels = network.getConfigurationLabels()
+    
+    prod, reac = getNetReactions(K, Nisom, Nreac)
+    if len(prod) == 0:
+        raise FitError('No net reactions with positive rate coefficients were found.')
+    klist = K[:,:,prod,reac]
+    
+    degreeT = min(degreeT, len(Tlist)); degreeP = min(degreeP, len(Plist))
+    chebyshev = fitChebyshev(Tlist, Plist, klist, degreeT, degreeP)
+    pdepArrhenius = fitPDepArrhenius(Tlist, Plist, klist)
+    
+    coeffs, chebError = chebyshev
+    A, n, Ea, plogError = pdepArrhenius
+    
+    logging.info('Fitted k(T,P) for %i net reactions:' % len(prod))
+    logging.info('    %-48s %16s %16s' % ('Reaction', 'Chebyshev error', 'PLOG error'))
+    for r in range(len(prod)):
+        logging.info('    %-48s %15.2f%% %15.2f%%' % ('%s -> %s' % (labels[reac[r]], labels[prod[r]]), chebError[r], plogError[r]))
+    logging.info('')
+    
+    for r in range(len(prod)):
+        logging.info('%s -> %s:' % (labels[reac[r]], labels[prod[r]]))
+        logging.info('    Chebyshev coefficients for %g to %g K and %g to %g bar:' % (min(Tlist), max(Tlist), min(Plist) / 1e5, max(Plist) / 1e5))
+        for t in range(degreeT):
+            logging.info('        ' + ' '.join(['%12.4e' % c for c in coeffs[r,t,:]]))
+        logging.info('    Pressure-dependent Arrhenius parameters:')
+        logging.info('        %12s %12s %12s %12s' % ('P (bar)', 'A', 'n', 'Ea (kJ/mol)'))
+        for p in range(len(Plist)):
+            logging.info('        %12g %12.4e %12.4f %12.4f' % (Plist[p] / 1e5, A[p,r], n[p,r], Ea[p,r] / 1000))
+        logging.info('')
+    
+    return (prod, reac), chebyshev, pdepArrhenius
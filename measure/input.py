@@ -56,6 +56,10 @@ Plist = None
 # The energy grains to use
 Elist = None
 
+# The largest energy grain size to use, if the energy grains are to become
+# coarser away from the threshold energies of the network
+maxGrainSize = 0.0
+
 # The method to use
 method = ''
 
@@ -170,18 +174,23 @@ def pressures(Plist0=None, Pmin=None, Pmax=None, count=None):
     else:
         raise SyntaxError('Must specify either a list of pressures or Pmin, Pmax, and count.')
 
-def energies(Emin=None, Emax=None, dE=None, count=None):
-    global Elist, network
+def energies(Emin=None, Emax=None, dE=None, count=None, dEmax=None):
+    global Elist, network, maxGrainSize
     if dE is not None or count is not None:
         dE = processQuantity(dE)[0]
         if dE is None: dE = 0.0
         if count is None: count = 0
+        if dEmax is not None: dEmax = processQuantity(dEmax)[0]
+        else: dEmax = 0.0
         if Emin is not None and Emax is not None:
             Emin = processQuantity(Emin)[0]
             Emax = processQuantity(Emax)[0]
             Elist = network.getEnergyGrains(Emin, Emax, dE, count)
+            # The non-uniform energy grains are generated once the whole input
+            # file has been read, since they depend on the collision model
+            maxGrainSize = dEmax
         else:
-            Elist = (dE, count)
+            Elist = (dE, count, dEmax)
     else:
         raise SyntaxError('Must specify either dE or count.')
 
@@ -193,19 +202,26 @@ def _method(name):
 
 def readInput(path):
 
-    global speciesDict, network, Tlist, Plist, Elist
+    global speciesDict, network, Tlist, Plist, Elist, method, maxGrainSize
     
     try:
         f = open(path)
     except IOError, e:
         logging.error('The input file "%s" could not be opened.' % path)
         logging.info('Check that the file exists and that you have read access.')
-        return
+        return None, None, None, None, None
     
     # Clear any existing loaded species
     speciesDict = {}
     # Create new network object
     network = Network()
+    # Clear the options set by any previous input file, which would otherwise
+    # be used for this one when several are read in the same process
+    Tlist = None
+    Plist = None
+    Elist = None
+    maxGrainSize = 0.0
+    method = ''
     
     logging.info('Reading input file "%s"...' % path)
 
@@ -237,9 +253,18 @@ def readInput(path):
     finally:
         f.close()
     
+    # The temperatures, pressures, energy grains, and method must all be
+    # specified
+    if network is not None:
+        missing = [name for name, value in [('temperatures', Tlist), ('pressures', Plist), ('energies', Elist)] if value is None]
+        if not method: missing.append('method')
+        if len(missing) > 0:
+            logging.error('The input file "%s" was invalid: it does not specify the %s.' % (path, ', '.join(missing)))
+            network = None
+    
     # If loading of the input file was unsuccessful for any reason,
     # then return None for everything so the program can terminate
-    if network is None: return None, None, None, None
+    if network is None: return None, None, None, None, None
     
     # Figure out which configurations are isomers, reactant channels, and product channels
     for rxn in network.pathReactions:
@@ -266,6 +291,12 @@ def readInput(path):
         elif rxn.products not in network.products:
             network.products.append(rxn.products)
     
+    # Make the energy grains coarser away from the threshold energies of the
+    # network, if requested, which requires the isomers and the collision 
+    # model to be known
+    if not isinstance(Elist, tuple) and maxGrainSize > Elist[1] - Elist[0]:
+        Elist = network.getNonuniformEnergyGrains(Elist[0], Elist[-1], Elist[1] - Elist[0], maxGrainSize)
+    
     # Print lots of information about the loaded network
     # In particular, we want to give all of the energies on the PES
     # This will help the user decide if the range of energies selected is 
@@ -292,7 +323,7 @@ def readInput(path):
     # If there are no isomers, then there's nothing to do
     if len(network.isomers) == 0:
         logging.info('Could not find any unimolecular isomers based on this network, so there is nothing to do.')
-        return None, None, None, None
+        return None, None, None, None, None
       
     
     return network, Tlist, Plist, Elist, method
@@ -33,7 +33,6 @@ for reducing a master equation model of unimolecular reaction networks to a set
 of phenomenological rate coefficients :math:`k(T,P)`.
 """
 
-import math
 import numpy
 
 import chempy.constants as constants
@@ -81,65 +80,50 @@ def applyModifiedStrongCollisionMethod(T, P, Elist, densStates, collFreq, Kij,
     if start < 0:
         raise ModifiedStrongCollisionError('Unable to determine starting grain; check active-state energies.')
 
-    # Iterate over the grains, calculating the PSSA concentrations
-    for r in range(start, Ngrains):
-
-        # Zero LHS matrix and RHS vectors
-        A = numpy.zeros((Nisom,Nisom), numpy.float64)
-        b = numpy.zeros((Nisom,Nisom+Nreac), numpy.float64)
-
-        # Populate LHS matrix
-        # Collisional deactivation
-        for i in range(Nisom):
-            A[i,i] -= collFreq[i]
-        # Isomerization reactions
-        for i in range(Nisom):
-            for j in range(i):
-                A[i,j] = Kij[i,j,r]
-                A[j,j] -= Kij[i,j,r]
-                A[j,i] = Kij[j,i,r]
-                A[i,i] -= Kij[j,i,r]
-        # Dissociation reactions
-        for n in range(Nreac+Nprod):
-            for j in range(Nisom):
-                A[j,j] -= Gnj[n,j,r]
-
-        # Populate RHS vectors, one per isomer and reactant
-        for i in range(Nisom):
-            # Thermal activation via collisions
-            b[i,i] = collFreq[i] * densStates[i,r] * math.exp(-Elist[r] / constants.R / T)
-        for n in range(Nisom, Nisom+Nreac):
-            # Chemical activation via association reaction
-            b[:,n] = Fim[:,n-Nisom,r] * (densStates[n,r] * math.exp(-Elist[r] / constants.R / T))
-
-        # Solve for steady-state population
-        pa[r,:,:] = -numpy.linalg.solve(A, b)
-        
+    # Assemble the LHS matrices and RHS vectors for all of the active grains
+    # at once, as stacks with one Nisom x Nisom matrix per grain
+    Nact = Ngrains - start
+    boltz = numpy.exp(-Elist[start:] / constants.R / T)
+    # Isomerization reactions (no isomer can isomerize to itself)
+    Kact = Kij[:,:,start:].copy()
+    for i in range(Nisom):
+        Kact[i,i,:] = 0
+    A = Kact.transpose(2,0,1).copy()
+    # Collisional deactivation, isomerization, and dissociation loss terms
+    diag = numpy.arange(Nisom)
+    A[:,diag,diag] -= collFreq + numpy.sum(Kact, axis=0).T + numpy.sum(Gnj[:,:,start:], axis=0).T
+    
+    # Populate RHS vectors, one per isomer and reactant
+    b = numpy.zeros((Nact,Nisom,Nisom+Nreac), numpy.float64)
+    # Thermal activation via collisions
+    b[:,diag,diag] = (collFreq.reshape(-1,1) * densStates[0:Nisom,start:] * boltz).T
+    # Chemical activation via association reaction
+    b[:,:,Nisom:] = (Fim[:,:,start:] * (densStates[Nisom:,start:] * boltz)).transpose(2,0,1)
+    
+    # Solve for steady-state population of every grain in one batched solve
+    pa[start:,:,:] = -numpy.linalg.solve(A, b)
             
     # Check that our populations are all positive
     if not (pa >= 0).all():
         raise ModifiedStrongCollisionError('A negative steady-state concentration was encountered.')
 
     # Compute rate coefficients from PSSA concentrations
-    for src in range(Nisom+Nreac):
-        # Calculate stabilization rates (i.e.) R + R' --> Ai or M --> Ai
-        for i in range(Nisom):
-            if i != src:
-                val = collFreq[i] * numpy.sum(pa[:,i,src])
-                K[i,src] += val
-                K[src,src] -= val
-        # Calculate dissociation rates (i.e.) R + R' --> Bn + Cn or M --> Bn + Cn
-        for n in range(Nreac+Nprod):
-            for j in range(Nisom):
-                if n + Nisom != src:
-                    val = numpy.sum(Gnj[n,j,:] * pa[:,j,src])
-                    K[n+Nisom,src] += val
-                    K[src,src] -= val
+    # Calculate stabilization rates (i.e.) R + R' --> Ai or M --> Ai
+    stab = collFreq.reshape(-1,1) * numpy.sum(pa, axis=0)
+    stab[diag,diag] = 0
+    # Calculate dissociation rates (i.e.) R + R' --> Bn + Cn or M --> Bn + Cn
+    diss = numpy.einsum('njr,rjs->ns', Gnj, pa)
+    diss[numpy.arange(Nreac),numpy.arange(Nisom,Nisom+Nreac)] = 0
+    K[0:Nisom,0:Nisom+Nreac] += stab
+    K[Nisom:,0:Nisom+Nreac] += diss
+    src = numpy.arange(Nisom+Nreac)
+    K[src,src] -= numpy.sum(stab, axis=0) + numpy.sum(diss, axis=0)
     
     # To complete pa we need the Boltzmann distribution at low energies
-    for i in range(Nisom):
-        for r in range(Ngrains):
-            if pa[r,i,i] == 0: pa[r,i,i] = densStates[i,r] * math.exp(-Elist[r] / constants.R / T)
+    paii = pa[:,diag,diag]
+    eqDist = (densStates[0:Nisom,:] * numpy.exp(-Elist / constants.R / T)).T
+    paii[paii == 0] = eqDist[paii == 0]
+    pa[:,diag,diag] = paii
 
     # Return the matrix of k(T,P) values and the pseudo-steady population distributions
     return K, pa
@@ -42,6 +42,8 @@ import chempy.states as states
 
 from reaction import *
 from collision import *
+import grains
+from timing import profiled, allocated
 
 ################################################################################
 
@@ -68,6 +70,7 @@ class Network:
     `bathGas`           :class:`Species`        The bath gas
     `collisionModel`    :class:`CollisionModel` The collision model to use
     `netReactions`      ``list``                A list of reaction objects that connect any pair of isomers
+    `statesCache`       :class:`StatesCache`    The cache to use for densities of states, or ``None`` to not cache them
     =================== ======================= ================================
 
     """
@@ -79,6 +82,18 @@ class Network:
         self.pathReactions = pathReactions or []
         self.bathGas = bathGas
         self.netReactions = []
+        self.statesCache = None
+    
+    def getConfigurationLabels(self):
+        """
+        Return a list of labels for the isomers, reactant channels, and 
+        product channels of the network, in the same order as the rows and
+        columns of the phenomenological rate coefficient matrix.
+        """
+        labels = [str(isomer) for isomer in self.isomers]
+        for configuration in self.reactants + self.products:
+            labels.append(' + '.join([str(spec) for spec in configuration]))
+        return labels
     
     def getEnergyGrains(self, Emin, Emax, dE=0.0, Ngrains=0):
         """
@@ -109,21 +124,52 @@ class Network:
             return numpy.arange(Emin, Emax + dE, dE, numpy.float64)
         else:
             return numpy.linspace(Emin, Emax, Ngrains, numpy.float64)
+    
+    def getThresholdEnergies(self):
+        """
+        Return a list of the energies in J/mol at which the behavior of the
+        network changes sharply: the ground-state energies of the isomers and
+        reactant channels and those of the transition states.
+        """
+        thresholds = [isomer.E0 for isomer in self.isomers]
+        thresholds.extend([sum([spec.E0 for spec in reactants]) for reactants in self.reactants])
+        thresholds.extend([rxn.transitionState.E0 for rxn in self.pathReactions if rxn.transitionState is not None])
+        return sorted(thresholds)
+    
+    def getNonuniformEnergyGrains(self, Emin, Emax, dE, dEmax, growth=0.1):
+        """
+        Return an array of energy grains from `Emin` to `Emax` that are spaced
+        by `dE` just above each of the threshold energies of the network (as
+        given by :meth:`getThresholdEnergies`), and become coarser above them
+        up to a spacing of `dEmax`; see 
+        :func:`grains.getNonuniformEnergyGrains`. All parameters and the 
+        returned energy grains are in J/mol. So that the rate coefficients 
+        remain converged, `dEmax` is reduced (with a warning) to the largest
+        grain size allowed by the collision model of the network, as given by
+        :func:`grains.getMaximumGrainSize`, if it is larger.
+        """
+        alpha = getattr(getattr(self, 'collisionModel', None), 'alpha', None)
+        if alpha:
+            limit = max(dE, grains.getMaximumGrainSize(alpha))
+            if dEmax > limit:
+                logging.warning('Reducing the maximum energy grain size from %g to %g kJ/mol, so that collisional energy transfer is resolved.' % (dEmax / 1000, limit / 1000))
+                dEmax = limit
+        return grains.getNonuniformEnergyGrains(Emin, Emax, dE, dEmax, self.getThresholdEnergies(), growth)
         
-    def autoGenerateEnergyGrains(self, Tmax, grainSize=0.0, Ngrains=0):
+    def autoGenerateEnergyGrains(self, Tmax, grainSize=0.0, Ngrains=0, maxGrainSize=0.0):
         """
         Select a suitable list of energies to use for subsequent calculations.
         The procedure is:
 
-        1. Calculate the equilibrium distribution of the highest-energy isomer
-           at the largest temperature of interest (to get the broadest
-           distribution)
+        1. Calculate the equilibrium distribution of each isomer at the largest
+           temperature of interest (to get the broadest distributions)
 
-        2. Calculate the energy at which the tail of the distribution is some
-           fraction of the maximum
+        2. Calculate the energy above the ground state of each isomer at which
+           the tail of its distribution is some fraction of the maximum, and 
+           which includes almost all of the distribution
 
-        3. Add the difference between the ground-state energy of the isomer and
-           the highest ground-state energy in the system (either isomer or
+        3. Add the largest of these energies to the highest ground-state 
+           energy in the system (either isomer, reactant channel, or 
            transition state)
 
         You must specify either the desired grain spacing `grainSize` in J/mol 
@@ -132,82 +178,113 @@ class Network:
         highest temperature of interest. You can specify both `grainSize` and 
         `Ngrains`, in which case the one that gives the more accurate result 
         will be used (i.e. they represent a maximum grain size and a minimum
-        number of grains). An array containing the energy grains in J/mol is 
-        returned.
+        number of grains). If a `maxGrainSize` in J/mol larger than this 
+        spacing is given, the energy grains have this spacing only near the 
+        threshold energies of the network, and become coarser away from them
+        (up to the maximum grain size); see :meth:`getNonuniformEnergyGrains`.
+        An array containing the energy grains in J/mol is returned.
         """
         
         if grainSize == 0.0 and Ngrains == 0:
             raise NetworkError('Must provide either grainSize or Ngrains parameter to Network.determineEnergyGrains().')
 
-        # For the purposes of finding the maximum energy we will use 251 grains
-        nE = 251; dE = 0.0
-
         # The minimum energy is the lowest isomer energy on the PES
-        Emin = 1.0e25
-        for species in self.isomers:
-            if species.E0 < Emin: Emin = species.E0
-        Emin = math.floor(Emin) # Round to nearest whole number
-
-        # Determine the isomer with the maximum ground-state energy
-        isomer = None
-        for species in self.isomers:
-            if isomer is None: isomer = species
-            elif species.E0 > isomer.E0: isomer = species
-        Emax0 = isomer.E0
-
-        # (Try to) purposely overestimate Emax using arbitrary multiplier
-        # to (hopefully) avoid multiple density of states calculations
-        mult = 50
-        done = False
+        Emin = math.floor(min([species.E0 for species in self.isomers])) # Round to nearest whole number
+
+        # Determine the width of the equilibrium distribution of each isomer,
+        # i.e. the energy above its ground state beyond which the tail of the
+        # distribution is negligible; the densities of states are computed 
+        # once, on grains extending (we hope) well beyond the tail of every
+        # isomer, and are only recomputed if this turns out not to be so
+        tol = 1e-4
+        nE = 201
+        mult = 100
         maxIter = 5
-        iterCount = 0
-        while not done and iterCount < maxIter:
-
-            iterCount += 1
+        width = None
+        for iterCount in range(maxIter):
             
-            Emax = math.ceil(Emax0 + mult * constants.R * Tmax)
-
-            Elist = self.getEnergyGrains(0.0, Emax-Emin, dE, nE)
-            densStates = isomer.states.getDensityOfStates(Elist)
+            Elist = self.getEnergyGrains(0.0, math.ceil(mult * constants.R * Tmax), 0.0, nE)
+            densStates = numpy.array([self.calculateDensityOfStates([species], Elist, 0.0) for species in self.isomers])
             eqDist = densStates * numpy.exp(-Elist / constants.R / Tmax)
-            eqDist /= numpy.sum(eqDist)
             
-            # Find maximum of distribution
-            maxIndex = eqDist.argmax()
+            # The last grain at which each distribution is not much lower 
+            # than its maximum
+            significant = eqDist >= tol * eqDist.max(axis=1).reshape(-1,1)
+            r = nE - 1 - numpy.argmax(significant[:,::-1], axis=1)
+            # The number of grains needed to capture almost all of each 
+            # distribution
+            cumDist = numpy.cumsum(eqDist, axis=1) / numpy.sum(eqDist, axis=1).reshape(-1,1)
+            r = numpy.maximum(r, numpy.sum(cumDist < 1.0 - tol, axis=1) + 1)
             
-            # If tail of distribution is much lower than the maximum, then we've found bounds for Emax
-            tol = 1e-4
-            if eqDist[-1] / eqDist[maxIndex] < tol:
-                r = nE - 1
-                while r > maxIndex and not done:
-                    if eqDist[r] / eqDist[maxIndex] > tol: done = True
-                    else: r -= 1
-                Emax = Elist[r] + Emin
-                # A final check to ensure we've captured almost all of the equilibrium distribution
-                if abs(1.0 - numpy.sum(eqDist[0:r]) / numpy.sum(eqDist)) > tol:
-                    done = False
-                    mult += 50
-            else:
-                mult += 50
+            if r.max() < nE - 1:
+                width = Elist[r.max()]
+                break
+            mult *= 2
+        
+        if width is None: width = Elist[-1]
 
-        # Add difference between isomer ground-state energy and highest
-        # transition state or reactant channel energy
-        Emax0_iso = Emin
+        # Add the width of the distribution to the highest ground-state 
+        # energy in the system (either isomer, reactant channel, or 
+        # transition state)
+        Emax0 = max([species.E0 for species in self.isomers])
         for species in self.reactants:
-            E = sum([spec.E0 for spec in species])
-            if Emax0_iso < E: Emax0_iso = E
-        Emax0_rxn = Emin
+            Emax0 = max(Emax0, sum([spec.E0 for spec in species]))
         for rxn in self.pathReactions:
             if rxn.transitionState is not None:
-                E = rxn.transitionState.E0
-                if Emax0_rxn < E: Emax0_rxn = E
-        Emax += max([isomer.E0, Emax0_iso, Emax0_rxn]) - isomer.E0
+                Emax0 = max(Emax0, rxn.transitionState.E0)
+        Emax = Emax0 + width
 
         # Round Emax up to nearest integer
         Emax = math.ceil(Emax)
 
         # Return the chosen energy grains
-        return self.getEnergyGrains(Emin, Emax, grainSize, Ngrains)
+        Elist = self.getEnergyGrains(Emin, Emax, grainSize, Ngrains)
+        if maxGrainSize > Elist[1] - Elist[0]:
+            Elist = self.getNonuniformEnergyGrains(Emin, Emax, Elist[1] - Elist[0], maxGrainSize)
+        return Elist
+
+    def getTransitionStateEnergies(self, Emin=0.0):
+        """
+        Return an array containing the ground-state energy in J/mol of the
+        transition state of each path reaction, relative to the energy `Emin`
+        in J/mol. The transition states themselves are not modified.
+        """
+        return numpy.array([rxn.transitionState.E0 - Emin for rxn in self.pathReactions], numpy.float64)
+
+    def calculateDensityOfStates(self, configuration, Elist, E0):
+        """
+        Calculate and return the density of states in mol/J of a 
+        `configuration`, i.e. a list containing either a single isomer or the
+        two species of a bimolecular reactant channel, at the energies `Elist`
+        in J/mol. The density of states is shifted by the ground-state energy
+        `E0` in J/mol to the common zero of energy. If the energy grains are 
+        not evenly spaced, the density of states is computed on the underlying
+        uniform lattice and averaged over each grain. If the network has a
+        :class:`StatesCache`, it is used to avoid recomputing densities of 
+        states that have been computed before.
+        """
+        
+        def calculateOnGrid(Elist):
+            densStates0 = configuration[0].states.getDensityOfStates(Elist)
+            for spec in configuration[1:]:
+                densStates0 = states.convolve(densStates0, spec.states.getDensityOfStates(Elist), Elist)
+            # Shift to common zero of energy
+            dE = Elist[1] - Elist[0]
+            r0 = int(round(E0 / dE))
+            densStates = numpy.zeros_like(densStates0)
+            densStates[r0:] = densStates0[:-r0+len(densStates0)]
+            return densStates
+        
+        def calculate():
+            if grains.isUniform(Elist):
+                return calculateOnGrid(Elist)
+            Elattice, indices = grains.getLattice(Elist)
+            return grains.averageOverGrains(calculateOnGrid(Elattice), indices)
+        
+        if self.statesCache is None:
+            return calculate()
+        key = self.statesCache.getKey('densStates', [spec.states for spec in configuration], E0, Elist)
+        return self.statesCache.getArray(key, calculate)
 
     def calculateDensitiesOfStates(self, Elist, E0):
         """
@@ -223,42 +300,75 @@ class Network:
         Nisom = len(self.isomers)
         Nreac = len(self.reactants)
         densStates = numpy.zeros((Nisom+Nreac, Ngrains), numpy.float64)
-        dE = Elist[1] - Elist[0]
         
         logging.info('Calculating densities of states...')
         
         # Densities of states for isomers
         for i in range(Nisom):
             logging.info('Calculating density of states for isomer "%s"' % self.isomers[i])
-            densStates0 = self.isomers[i].states.getDensityOfStates(Elist)
-            # Shift to common zero of energy
-            r0 = int(round(E0[i] / dE))
-            densStates[i,r0:] = densStates0[:-r0+len(densStates0)]
+            densStates[i,:] = self.calculateDensityOfStates([self.isomers[i]], Elist, E0[i])
         
         # Densities of states for reactant channels
         for n in range(Nreac):
             if self.reactants[n][0].states is not None and self.reactants[n][1].states is not None:
                 logging.debug('Calculating density of states for reactant channel "%s"' % (' + '.join([str(spec) for spec in self.reactants[n]])))
-                densStates0 = self.reactants[n][0].states.getDensityOfStates(Elist)
-                densStates1 = self.reactants[n][1].states.getDensityOfStates(Elist)
-                densStates0 = states.convolve(densStates0, densStates1, Elist)
-                # Shift to common zero of energy
-                r0 = int(round(E0[n+Nisom] / dE))
-                densStates[n+Nisom,r0:] = densStates0[:-r0+len(densStates0)]
+                densStates[n+Nisom,:] = self.calculateDensityOfStates(self.reactants[n], Elist, E0[n+Nisom])
             else:
                 logging.debug('NOT calculating density of states for reactant channel "%s"' % (' + '.join([str(spec) for spec in self.reactants[n]])))
         logging.debug('')
         
         return densStates
 
-    def calculateMicrocanonicalRates(self, Elist, densStates, T=None):
+    def calculateSumsOfStates(self, Elist, E0TS=None):
+        """
+        Calculate and return a list containing the sum of states of the 
+        transition state of each path reaction for which RRKM theory will be
+        used, shifted to the common zero of energy, at the energies `Elist` in
+        J/mol. The list has one item per path reaction, which is ``None`` for
+        path reactions that do not have molecular degree of freedom data for
+        their transition state. The sums of states do not depend on 
+        temperature, so this need only be called once for a given set of energy
+        grains. The ground-state energies of the transition states `E0TS` in
+        J/mol, on the same scale as `Elist`, are those returned by 
+        :meth:`getTransitionStateEnergies`, which is called if they are not 
+        given. If the network has a :class:`StatesCache`, it is used to avoid
+        recomputing sums of states that have been computed before.
+        """
+        
+        if E0TS is None:
+            E0TS = self.getTransitionStateEnergies()
+        
+        sumStates = []
+        for rxn, E0 in zip(self.pathReactions, E0TS):
+            TS = rxn.transitionState
+            if TS.states is None:
+                sumStates.append(None)
+            elif self.statesCache is None:
+                sumStates.append(calculateSumOfStates(TS, Elist, E0))
+            else:
+                key = self.statesCache.getKey('sumStates', [TS.states], E0, Elist)
+                sumStates.append(self.statesCache.getArray(key, lambda: calculateSumOfStates(TS, Elist, E0)))
+        
+        return sumStates
+
+    def calculateMicrocanonicalRates(self, Elist, densStates, T=None, sumStates=None, pathReactions=None, rates=None, E0TS=None):
         """
         Calculate and return arrays containing the microcanonical rate 
         coefficients :math:`k(E)` for the isomerization, dissociation, and
         association path reactions in the network. `Elist` represents the
         array of energies in J/mol at which to compute each density of states,
         while `densStates` represents the density of states of each isomer and
-        reactant channel in mol/J.
+        reactant channel in mol/J. The sums of states `sumStates` of the 
+        transition states, as returned by :meth:`calculateSumsOfStates`, are
+        computed if not given. 
+        
+        By default the :math:`k(E)` of every path reaction are computed. If a
+        list `pathReactions` is given, only those path reactions are computed,
+        and the :math:`k(E)` of the others are copied from the tuple of arrays
+        ``(Kij, Gnj, Fim)`` given as `rates`, if any (e.g. from an earlier call
+        for the path reactions whose :math:`k(E)` do not depend on 
+        temperature). The ground-state energies of the transition states 
+        `E0TS` are as for :meth:`calculateSumsOfStates`.
         """
         
         Ngrains = len(Elist)
@@ -266,148 +376,508 @@ class Network:
         Nreac = len(self.reactants)
         Nprod = len(self.products)
         
-        Kij = numpy.zeros([Nisom,Nisom,Ngrains], numpy.float64)
-        Gnj = numpy.zeros([Nreac+Nprod,Nisom,Ngrains], numpy.float64)
-        Fim = numpy.zeros([Nisom,Nreac,Ngrains], numpy.float64)
+        if rates is not None:
+            Kij, Gnj, Fim = [array.copy() for array in rates]
+        else:
+            Kij = numpy.zeros([Nisom,Nisom,Ngrains], numpy.float64)
+            Gnj = numpy.zeros([Nreac+Nprod,Nisom,Ngrains], numpy.float64)
+            Fim = numpy.zeros([Nisom,Nreac,Ngrains], numpy.float64)
+        
+        if E0TS is None:
+            E0TS = self.getTransitionStateEnergies()
+        if sumStates is None:
+            sumStates = self.calculateSumsOfStates(Elist, E0TS)
+        if pathReactions is None:
+            pathReactions = self.pathReactions
         
         logging.info('Calculating microcanonical rate coefficients k(E)...')
         
-        for rxn in self.pathReactions:
+        for rxn in pathReactions:
+            N = sumStates[self.pathReactions.index(rxn)]
+            E0 = E0TS[self.pathReactions.index(rxn)]
             if rxn.reactants[0] in self.isomers and rxn.products[0] in self.isomers:
                 # Isomerization
                 reac = self.isomers.index(rxn.reactants[0])
                 prod = self.isomers.index(rxn.products[0])
-                Kij[prod,reac,:], Kij[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], densStates[prod,:], T)
+                Kij[prod,reac,:], Kij[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], densStates[prod,:], T, N, E0)
             elif rxn.reactants[0] in self.isomers and rxn.products in self.reactants:
                 # Dissociation (reversible)
                 reac = self.isomers.index(rxn.reactants[0])
                 prod = self.reactants.index(rxn.products)
-                Gnj[prod,reac,:], Fim[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], densStates[prod+Nisom,:], T)
+                Gnj[prod,reac,:], Fim[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], densStates[prod+Nisom,:], T, N, E0)
             elif rxn.reactants[0] in self.isomers and rxn.products in self.products:
                 # Dissociation (irreversible)
                 reac = self.isomers.index(rxn.reactants[0])
                 prod = self.products.index(rxn.products) + Nreac
-                Gnj[prod,reac,:], dummy = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], None, T)
+                Gnj[prod,reac,:], dummy = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac,:], None, T, N, E0)
             elif rxn.reactants in self.reactants and rxn.products[0] in self.isomers:
                 # Association
                 reac = self.reactants.index(rxn.reactants)
                 prod = self.isomers.index(rxn.products[0])
-                Fim[prod,reac,:], Gnj[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac+Nisom,:], densStates[prod,:], T)
+                Fim[prod,reac,:], Gnj[reac,prod,:] = calculateMicrocanonicalRateCoefficient(rxn, Elist, densStates[reac+Nisom,:], densStates[prod,:], T, N, E0)
             else:
                 raise NetworkError('Unexpected type of path reaction "%s"' % rxn)
         logging.debug('')
         
         return Kij, Gnj, Fim
         
-    def calculateRateCoefficients(self, Tlist, Plist, Elist, method):
+    def calculateRateCoefficients(self, Tlist, Plist, Elist, method, workers=1, collisionTolerance=1e-8, returnPopulations=False, checkpoint=None, profile=None, densStates0=None, sumStates=None, rates0=None):
         """
         Calculate the phenomenological rate coefficients :math:`k(T,P)` for the
         network at the given temperatures `Tlist` in K and pressures `Plist` in
         Pa. The `method` string is used to indicate the method to use, and
         should be one of "modified strong collision", "reservoir state", or
-        "chemically-significant eigenvalues".
+        "chemically-significant eigenvalues". If `workers` is greater than one,
+        the temperatures are distributed across a pool of that many worker
+        processes; the results are identical to those of the serial
+        calculation. For the methods that use the full collision matrix, 
+        entries smaller than `collisionTolerance` times the diagonal entry of 
+        their column are neglected. If `returnPopulations` is ``True``, the
+        population distributions returned by the method at each temperature
+        and pressure are also returned, as an array whose first two indices
+        are those of the temperature and pressure. If a :class:`Checkpoint` 
+        object `checkpoint` is given, the rate coefficients at each temperature
+        and pressure are saved to it as soon as they are computed (or, when 
+        run in parallel, as soon as each temperature is completed), and any
+        points already in it are not recomputed. If a :class:`Profiler` object `profile` is
+        given, the time and memory used by each stage of the calculation are
+        recorded in it. The densities of states `densStates0` and sums of 
+        states `sumStates` at the energies `Elist`, shifted such that the 
+        lowest grain is zero, as returned by :meth:`calculateDensitiesOfStates`
+        and :meth:`calculateSumsOfStates`, can be given if they are already
+        known, in which case they are not recomputed. Likewise, the tuple of
+        arrays ``(Kij, Gnj, Fim)`` given as `rates0` is used for the 
+        microcanonical rate coefficients of the path reactions whose 
+        :math:`k(E)` do not depend on temperature.
+        
+        Neither `Elist` nor the network (including the species and transition
+        states) is modified, so several calculations can be run on the same
+        network at once, e.g. from different threads.
         """
 
-        # Determine the values of some counters
-        Ngrains = len(Elist)
+        with profiled(profile, 'calculateRateCoefficients'):
+            # Determine the values of some counters
+            Nisom = len(self.isomers)
+            Nreac = len(self.reactants)
+            Nprod = len(self.products)
+        
+            # Get ground-state energies of all isomers and each reactant channel
+            # that has the necessary parameters
+            # An exception will be raised if a unimolecular isomer is missing
+            # this information
+            E0 = numpy.zeros((Nisom+Nreac), numpy.float64)
+            for i in range(Nisom):
+                E0[i] = self.isomers[i].E0
+            for n in range(Nreac):
+                E0[n+Nisom] = sum([spec.E0 for spec in self.reactants[n]])
+        
+            # Get first reactive grain for each isomer
+            Ereac = numpy.ones(Nisom, numpy.float64) * 1e20
+            for i in range(Nisom):
+                for rxn in self.pathReactions:
+                    if rxn.reactants[0] == self.isomers[i] or rxn.products[0] == self.isomers[i]:
+                        if rxn.transitionState.E0 < Ereac[i]: 
+                            Ereac[i] = rxn.transitionState.E0
+        
+            # Shift energy grains such that lowest is zero
+            # The shifted energies are new arrays, so that neither the caller's
+            # energy grains nor the transition states are modified
+            Emin = Elist[0]
+            E0TS = self.getTransitionStateEnergies(Emin)
+            E0 = E0 - Emin
+            Ereac = Ereac - Emin
+            Elist = Elist - Emin
+
+            # Calculate density of states for each isomer and each reactant channel
+            # that has the necessary parameters
+            if densStates0 is None:
+                with profiled(profile, 'calculateDensitiesOfStates'):
+                    densStates0 = self.calculateDensitiesOfStates(Elist, E0)
+                    allocated(profile, densStates0)
+
+            # Calculate the microcanonical rate coefficients for the path reactions
+            # whose k(E) do not depend on temperature; the remaining path 
+            # reactions are recomputed for each temperature
+            if sumStates is None:
+                with profiled(profile, 'calculateSumsOfStates'):
+                    sumStates = self.calculateSumsOfStates(Elist, E0TS)
+                    allocated(profile, sumStates)
+            if rates0 is None:
+                with profiled(profile, 'calculateMicrocanonicalRates'):
+                    rates0 = self.calculateMicrocanonicalRates(Elist, densStates0, None, sumStates, 
+                        [rxn for rxn in self.pathReactions if not isTemperatureDependent(rxn)], None, E0TS)
+                    allocated(profile, rates0)
+
+            K = numpy.zeros((len(Tlist),len(Plist),Nisom+Nreac+Nprod,Nisom+Nreac+Nprod), numpy.float64)
+            allocated(profile, K)
+            pa = None
+        
+            # Determine the pressures at which each temperature remains to be 
+            # computed; the points completed in a previous run are taken from the
+            # checkpoint instead (unless the populations are needed, since these
+            # are not checkpointed)
+            tasks = []
+            for t, T in enumerate(Tlist):
+                indices = []
+                for p, P in enumerate(Plist):
+                    Kp = None
+                    if checkpoint is not None and not returnPopulations:
+                        Kp = checkpoint.getRateCoefficients(T, P)
+                    if Kp is None:
+                        indices.append(p)
+                    else:
+                        K[t,p,:,:] = Kp
+                if len(indices) > 0:
+                    tasks.append((t, T, numpy.array(Plist)[indices]))
+                    if len(indices) < len(Plist):
+                        logging.info('Resuming calculation at %g K from checkpoint.' % T)
+                elif checkpoint is not None:
+                    logging.info('Skipping %g K, which was completed in a previous run.' % T)
+        
+            if workers > 1 and len(tasks) > 1:
+                # Each worker process receives the network and the densities of
+                # states once, when it is started, and then computes the rate
+                # coefficients at one temperature per task; if profiling, each
+                # task is profiled separately and returns its profile
+                import multiprocessing
+                pool = multiprocessing.Pool(min(workers, len(tasks)), initializer=initializeWorker,
+                    initargs=(self, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations, E0TS, profile.memory if profile is not None else None))
+                results = pool.imap_unordered(calculateRateCoefficientsWorker, tasks, chunksize=1)
+            else:
+                pool = None
+                callback = None
+                if checkpoint is not None:
+                    callback = lambda T, P, Kp: checkpoint.save(T, [P], [Kp])
+                results = ((t, Plist0, self.calculateRateCoefficientsAtTemperature(T, Plist0, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations, E0TS, profile, callback), None) for t, T, Plist0 in tasks)
+        
+            # Store (and checkpoint) the results at each temperature as soon as
+            # they are available; when run serially, each point is instead 
+            # checkpointed as soon as it is computed
+            try:
+                for t, Plist0, result, taskProfile in results:
+                    if taskProfile is not None:
+                        profile.merge(taskProfile)
+                    if returnPopulations:
+                        result, pat = result
+                        if pa is None:
+                            pa = numpy.zeros((len(Tlist),) + pat.shape, numpy.float64)
+                            allocated(profile, pa)
+                        pa[t,...] = pat
+                    K[t,[list(Plist).index(P) for P in Plist0],:,:] = result
+                    if checkpoint is not None and pool is not None:
+                        checkpoint.save(Tlist[t], Plist0, result)
+                if pool is not None: pool.close()
+            except:
+                if pool is not None: pool.terminate()
+                raise
+            finally:
+                if pool is not None: pool.join()
+
+        if returnPopulations:
+            return K, pa
+        return K
+
+    def calculateConvergedRateCoefficients(self, Tlist, Plist, Elist, method, tolerance=0.01, maxRefinements=3, extrapolate=False, significance=1e-6, workers=1, collisionTolerance=1e-8, profile=None):
+        """
+        Calculate the phenomenological rate coefficients :math:`k(T,P)` for the
+        network at the given temperatures `Tlist` in K and pressures `Plist` in
+        Pa, as :meth:`calculateRateCoefficients` does, but on successively
+        finer energy grains until the rate coefficients have converged. The 
+        energy grains `Elist` in J/mol (e.g. from 
+        :meth:`autoGenerateEnergyGrains`) are the coarsest used; each 
+        refinement splits every grain in two, until no rate coefficient 
+        changes by more than the relative `tolerance` or the grains have been
+        refined `maxRefinements` times. Only the significant rate 
+        coefficients are tested: those of net reactions (i.e. off the 
+        diagonal) that are at least `significance` times the largest rate 
+        coefficient out of the same configuration at the same temperature and
+        pressure. If `extrapolate` is ``True``, the rate coefficients from the
+        last two sets of grains are Richardson extrapolated to zero grain 
+        size, assuming that their error is proportional to the grain size; 
+        any rate coefficient whose sign the extrapolation would change is 
+        left unextrapolated. The remaining parameters are passed to 
+        :meth:`calculateRateCoefficients`.
+        
+        The densities and sums of states and the microcanonical rate 
+        coefficients :math:`k(E)` of the path reactions that do not depend on
+        temperature are computed only once, on the finest energy grains that
+        may be needed, and sampled at the coarser grains, all of which lie on 
+        them. The finest grains span the same range as `Elist`, whose first 
+        and last grains are kept by every refinement.
+        
+        The rate coefficients and the energy grains in J/mol on which they 
+        were last computed are returned. A warning is logged if the rate 
+        coefficients have not converged after the last refinement.
+        """
+        
         Nisom = len(self.isomers)
         Nreac = len(self.reactants)
-        Nprod = len(self.products)
-        dE = Elist[1] - Elist[0]
         
-        # Get ground-state energies of all isomers and each reactant channel
-        # that has the necessary parameters
-        # An exception will be raised if a unimolecular isomer is missing
-        # this information
+        # The finest energy grains split the interval between each pair of 
+        # adjacent grains into 2**maxRefinements equal parts, ending at the 
+        # last grain; each coarser set of grains takes every other point of
+        # the next finer one
+        Nsplit = 2**maxRefinements
+        dE = numpy.diff(Elist)
+        Elattice = numpy.hstack([(Elist[:-1].reshape(-1,1) + dE.reshape(-1,1) * numpy.arange(Nsplit).reshape(1,-1) / Nsplit).flatten(), Elist[-1:]])
+        
+        # Compute the densities of states, sums of states, and temperature-
+        # independent k(E) on the finest energy grains, shifted such that the
+        # lowest grain is zero
         E0 = numpy.zeros((Nisom+Nreac), numpy.float64)
         for i in range(Nisom):
             E0[i] = self.isomers[i].E0
         for n in range(Nreac):
             E0[n+Nisom] = sum([spec.E0 for spec in self.reactants[n]])
+        Emin = Elist[0]
+        E0TS = self.getTransitionStateEnergies(Emin)
+        with profiled(profile, 'calculateDensitiesOfStates'):
+            densStatesLattice = self.calculateDensitiesOfStates(Elattice - Emin, E0 - Emin)
+            allocated(profile, densStatesLattice)
+        with profiled(profile, 'calculateSumsOfStates'):
+            sumStatesLattice = self.calculateSumsOfStates(Elattice - Emin, E0TS)
+            allocated(profile, sumStatesLattice)
+        with profiled(profile, 'calculateMicrocanonicalRates'):
+            ratesLattice = self.calculateMicrocanonicalRates(Elattice - Emin, densStatesLattice, None, sumStatesLattice, 
+                [rxn for rxn in self.pathReactions if not isTemperatureDependent(rxn)], None, E0TS)
+            allocated(profile, ratesLattice)
         
-        # Get first reactive grain for each isomer
-        Ereac = numpy.ones(Nisom, numpy.float64) * 1e20
-        for i in range(Nisom):
-            for rxn in self.pathReactions:
-                if rxn.reactants[0] == self.isomers[i] or rxn.products[0] == self.isomers[i]:
-                    if rxn.transitionState.E0 < Ereac[i]: 
-                        Ereac[i] = rxn.transitionState.E0
+        K = None
+        for level in range(maxRefinements+1):
+            
+            step = 2**(maxRefinements - level)
+            indices = numpy.arange(0, len(Elattice), step)
+            Elist = Elattice[indices]
+            densStates0 = densStatesLattice[:,indices]
+            sumStates = [N[indices] if N is not None else None for N in sumStatesLattice]
+            rates0 = tuple([rates[:,:,indices] for rates in ratesLattice])
+            
+            logging.info('Calculating k(T,P) values using %i energy grains...' % len(Elist))
+            Kprev = K
+            K = self.calculateRateCoefficients(Tlist, Plist, Elist, method, workers=workers, collisionTolerance=collisionTolerance, profile=profile, densStates0=densStates0, sumStates=sumStates, rates0=rates0)
+            if Kprev is None: continue
+            
+            # Determine the largest relative change in any significant rate
+            # coefficient; the diagonal entries and the negligible net 
+            # reactions (e.g. those whose rate coefficients are near the
+            # limit of roundoff error) are not considered
+            significant = getSignificantRateCoefficients(K, significance)
+            change = numpy.max(numpy.abs(K - Kprev)[significant] / numpy.abs(K)[significant]) if significant.any() else 0.0
+            logging.info('The largest relative change in k(T,P) from the previous energy grains is %g.' % change)
+            if change < tolerance: break
         
-        # Shift energy grains such that lowest is zero
-        Emin = Elist[0]
-        for rxn in self.pathReactions:
-            rxn.transitionState.E0 -= Emin
-        E0 -= Emin
-        Ereac -= Emin
-        Elist -= Emin
-
-        # Calculate density of states for each isomer and each reactant channel
-        # that has the necessary parameters
-        densStates0 = self.calculateDensitiesOfStates(Elist, E0)
+        else:
+            if maxRefinements > 0:
+                logging.warning('The k(T,P) values did not converge to within a relative tolerance of %g in %i refinements of the energy grains.' % (tolerance, maxRefinements))
+        
+        # Richardson extrapolate to zero grain size, assuming a first-order
+        # error in the grain size, which is halved by each refinement
+        # The extrapolation is not used for any rate coefficient whose sign
+        # it would change, e.g. a small rate coefficient that changes
+        # rapidly with the grain size
+        if extrapolate and Kprev is not None:
+            Kext = 2 * K - Kprev
+            invalid = numpy.sign(Kext) != numpy.sign(K)
+            if invalid.any():
+                logging.warning('Extrapolating to zero grain size would change the sign of %i k(T,P) values, so these were not extrapolated.' % numpy.count_nonzero(invalid))
+                Kext[invalid] = K[invalid]
+            K = Kext
+        
+        return K, Elist
 
-        K = numpy.zeros((len(Tlist),len(Plist),Nisom+Nreac+Nprod,Nisom+Nreac+Nprod), numpy.float64)
+    def calculateRateCoefficientsAtTemperature(self, T, Plist, Elist, densStates0, E0, Ereac, method, collisionTolerance=1e-8, sumStates=None, rates0=None, returnPopulations=False, E0TS=None, profile=None, callback=None):
+        """
+        Calculate the phenomenological rate coefficients :math:`k(T,P)` for the
+        network at a single temperature `T` in K and each of the pressures
+        `Plist` in Pa, returning an array of shape 
+        ``(len(Plist), Nisom+Nreac+Nprod, Nisom+Nreac+Nprod)``. This is the 
+        inner part of :meth:`calculateRateCoefficients`, and expects the energy
+        grains `Elist`, ground-state energies `E0`, first reactive energies 
+        `Ereac`, and transition state energies `E0TS` (all in J/mol) to 
+        already be shifted such that the lowest grain is zero; if `E0TS` is
+        not given, the energies of the transition states are used unshifted. The unnormalized densities of states 
+        `densStates0` in mol/J are those returned by 
+        :meth:`calculateDensitiesOfStates`. The sums of states `sumStates` are
+        those returned by :meth:`calculateSumsOfStates`, and `rates0` is an
+        optional tuple of arrays ``(Kij, Gnj, Fim)`` containing the 
+        microcanonical rate coefficients of the path reactions whose 
+        :math:`k(E)` do not depend on temperature, which are then not 
+        recomputed. The remaining parameters are as for 
+        :meth:`calculateRateCoefficients`; if `returnPopulations` is ``True``
+        the population distributions at each pressure are also returned. If
+        `callback` is given, it is called with the temperature, pressure, and
+        rate coefficient matrix as each pressure is completed.
+        """
         
-        for t, T in enumerate(Tlist):
-            
+        with profiled(profile, 'calculateRateCoefficientsAtTemperature'):
+            Ngrains = len(Elist)
+            Nisom = len(self.isomers)
+            Nreac = len(self.reactants)
+            Nprod = len(self.products)
+            dE = grains.getGrainWidths(Elist)
+
+            K = numpy.zeros((len(Plist),Nisom+Nreac+Nprod,Nisom+Nreac+Nprod), numpy.float64)
+            pa = None
+
             # Calculate microcanonical rate coefficients for each path reaction
             # If degree of freedom data is provided for the transition state, then RRKM theory is used
             # If high-pressure limit Arrhenius data is provided, then the inverse Laplace transform method is used
             # Otherwise an exception is raised
             # This is only dependent on temperature for the ILT method with
-            # certain Arrhenius parameters
-            Kij, Gnj, Fim = self.calculateMicrocanonicalRates(Elist, densStates0, T)
+            # certain Arrhenius parameters, so if the temperature-independent 
+            # rates are given only the remaining path reactions are computed here
+            if E0TS is None:
+                E0TS = self.getTransitionStateEnergies()
+            if sumStates is None:
+                sumStates = self.calculateSumsOfStates(Elist, E0TS)
+            if rates0 is None:
+                Kij, Gnj, Fim = self.calculateMicrocanonicalRates(Elist, densStates0, T, sumStates, None, None, E0TS)
+            else:
+                pathReactions = [rxn for rxn in self.pathReactions if isTemperatureDependent(rxn)]
+                if len(pathReactions) > 0:
+                    with profiled(profile, 'calculateMicrocanonicalRates'):
+                        Kij, Gnj, Fim = self.calculateMicrocanonicalRates(Elist, densStates0, T, sumStates, pathReactions, rates0, E0TS)
+                        allocated(profile, Kij, Gnj, Fim)
+                else:
+                    Kij, Gnj, Fim = rates0
 
             # Rescale densities of states such that, when they are integrated
             # using the Boltzmann factor as a weighting factor, the result is unity
+            # For energy grains that are not evenly spaced, the integral weights
+            # each grain by its own width
             densStates = numpy.zeros_like(densStates0)
             eqRatios = numpy.zeros(Nisom+Nreac, numpy.float64)
             for i in range(Nisom+Nreac):
-                eqRatios[i] = numpy.sum(densStates0[i,:] * numpy.exp(-Elist / constants.R / T)) * dE
+                if numpy.isscalar(dE):
+                    eqRatios[i] = numpy.sum(densStates0[i,:] * numpy.exp(-Elist / constants.R / T)) * dE
+                else:
+                    eqRatios[i] = numpy.sum(densStates0[i,:] * numpy.exp(-Elist / constants.R / T) * dE)
                 densStates[i,:] = densStates0[i,:] / eqRatios[i] * dE
+
+            # The collisional transfer probabilities depend only on temperature and
+            # the density of states, so for the methods that use the full collision
+            # matrix we generate them once here; the pressure dependence enters
+            # only through the collision frequency, which is applied below
+            # Only the band of each matrix containing non-negligible entries is kept
+            # Likewise, the collision efficiencies used in the modified strong 
+            # collision method depend on temperature but not pressure
+            if method.lower() in ['reservoir state', 'chemically-significant eigenvalues']:
+                with profiled(profile, 'generateBandedCollisionMatrix'):
+                    Pcoll = [self.collisionModel.generateBandedCollisionMatrix(Elist, T, densStates[i,:], collisionTolerance) for i in range(Nisom)]
+                    allocated(profile, Pcoll)
+            elif method.lower() == 'modified strong collision':
+                with profiled(profile, 'calculateCollisionEfficiency'):
+                    collEff = numpy.zeros(Nisom, numpy.float64)
+                    for i in range(Nisom):
+                        collEff[i] = calculateCollisionEfficiency(self.isomers[i], T, Elist, densStates[i,:], self.collisionModel, E0[i], Ereac[i])
         
+            # Calculate collision frequencies of each isomer at every pressure
+            collFreqs = numpy.zeros((len(Plist),Nisom), numpy.float64)
             for p, P in enumerate(Plist):
-                
-                logging.info('Calculating k(T,P) values at %g K, %g bar...' % (T, P/1e5))
-                
-                # Calculate collision frequencies
-                collFreq = numpy.zeros(Nisom, numpy.float64)
                 for i in range(Nisom):
-                    collFreq[i] = calculateCollisionFrequency(self.isomers[i], T, P, self.bathGas)
-                
+                    collFreqs[p,i] = calculateCollisionFrequency(self.isomers[i], T, P, self.bathGas)
+    
+            for p, P in enumerate(Plist):
+            
+                logging.info('Calculating k(T,P) values at %g K, %g bar...' % (T, P/1e5))
+            
+                collFreq = collFreqs[p,:]
+            
                 # Apply method
                 if method.lower() == 'modified strong collision':
                     # Modify collision frequencies using efficiency factor
-                    for i in range(Nisom): 
-                        collFreq[i] *= calculateCollisionEfficiency(self.isomers[i], T, Elist, densStates[i,:], self.collisionModel, E0[i], Ereac[i])
+                    collFreq = collFreq * collEff
                     # Apply modified strong collision method
                     import msc
-                    K[t,p,:,:], p0 = msc.applyModifiedStrongCollisionMethod(T, P, Elist, densStates, collFreq, Kij, Fim, Gnj, Ereac, Nisom, Nreac, Nprod)
+                    with profiled(profile, 'applyModifiedStrongCollisionMethod', T, P):
+                        K[p,:,:], p0 = msc.applyModifiedStrongCollisionMethod(T, P, Elist, densStates, collFreq, Kij, Fim, Gnj, Ereac, Nisom, Nreac, Nprod)
+                        allocated(profile, K[p,:,:], p0)
                 elif method.lower() == 'reservoir state':
-                    # The full collision matrix for each isomer
-                    Mcoll = numpy.zeros((Nisom,Ngrains,Ngrains), numpy.float64)
-                    for i in range(Nisom):
-                        Mcoll[i,:,:] = collFreq[i] * self.collisionModel.generateCollisionMatrix(Elist, T, densStates[i,:])
                     # Apply reservoir state method
-                    import rs
-                    K[t,p,:,:], p0 = rs.applyReservoirStateMethod(T, P, Elist, densStates, Mcoll, Kij, Fim, Gnj, Ereac, Nisom, Nreac, Nprod)
+                    # All of the pressures are solved together on the first pass,
+                    # so that the work can be shared between them (and so are 
+                    # profiled as a single point)
+                    if p == 0:
+                        import rs
+                        with profiled(profile, 'applyReservoirStateMethod', T):
+                            Krs, pars = rs.applyReservoirStateMethodMultiplePressures(T, Plist, Elist, densStates, Pcoll, collFreqs, Kij, Fim, Gnj, Ereac, Nisom, Nreac, Nprod, collisionTolerance)
+                            allocated(profile, Krs, pars)
+                    K[p,:,:] = Krs[p,:,:]; p0 = pars[p,...]
                 elif method.lower() == 'chemically-significant eigenvalues':
-                    # The full collision matrix for each isomer
-                    Mcoll = numpy.zeros((Nisom,Ngrains,Ngrains), numpy.float64)
-                    for i in range(Nisom):
-                        Mcoll[i,:,:] = collFreq[i] * self.collisionModel.generateCollisionMatrix(Elist, T, densStates[i,:])
+                    # The collision matrix for each isomer
+                    Mcoll = [Pcoll[i] * collFreq[i] for i in range(Nisom)]
                     # Apply chemically-significant eigenvalues method
                     import cse
-                    K[t,p,:,:], p0 = cse.applyChemicallySignificantEigenvaluesMethod(T, P, Elist, densStates, Mcoll, Kij, Fim, Gnj, eqRatios, Nisom, Nreac, Nprod)
+                    with profiled(profile, 'applyChemicallySignificantEigenvaluesMethod', T, P):
+                        K[p,:,:], p0 = cse.applyChemicallySignificantEigenvaluesMethod(T, P, Elist, densStates, Mcoll, Kij, Fim, Gnj, eqRatios, Nisom, Nreac, Nprod)
+                        allocated(profile, K[p,:,:], p0)
                 else:
                     raise NetworkError('Unknown method "%s".' % method)
 
-                logging.debug(K[t,p,0:Nisom+Nreac+Nprod,0:Nisom+Nreac])
+                logging.debug(K[p,0:Nisom+Nreac+Nprod,0:Nisom+Nreac])
 
                 logging.debug('')
+            
+                if callback is not None:
+                    callback(T, P, K[p,:,:])
+            
+                if returnPopulations:
+                    if pa is None:
+                        pa = numpy.zeros((len(Plist),) + p0.shape, numpy.float64)
+                    pa[p,...] = p0
 
-        # Unshift energy grains
-        for rxn in self.pathReactions:
-            rxn.transitionState.E0 += Emin
-        Elist += Emin
-
+        if returnPopulations:
+            return K, pa
         return K
+
+################################################################################
+
+def getSignificantRateCoefficients(K, significance=1e-6):
+    """
+    Return a boolean array of the same shape as the array of phenomenological
+    rate coefficients `K`, whose last two indices are those of the product 
+    and reactant configurations, that is ``True`` for the rate coefficients
+    of net reactions that are at least `significance` times the largest rate 
+    coefficient of any net reaction out of the same configuration at the 
+    same temperature and pressure.
+    """
+    Kabs = numpy.abs(K)
+    offdiagonal = ~numpy.eye(K.shape[-2], K.shape[-1], dtype=bool)
+    Kmax = numpy.max(numpy.where(offdiagonal, Kabs, 0.0), axis=-2)
+    return offdiagonal & (Kabs > 0) & (Kabs >= significance * Kmax[...,numpy.newaxis,:])
+
+################################################################################
+
+# The network and the temperature-independent data used by each worker process
+# when the rate coefficient calculation is run in parallel
+workerData = None
+
+def initializeWorker(network, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations=False, E0TS=None, profiling=None):
+    """
+    Store the data needed to compute rate coefficients in a worker process.
+    This is called once when each worker process in the pool is started. If
+    `profiling` is not ``None``, each task is profiled, measuring memory if
+    it is ``True``.
+    """
+    global workerData
+    workerData = (network, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations, E0TS, profiling)
+
+def calculateRateCoefficientsWorker(task):
+    """
+    Calculate the phenomenological rate coefficients in a worker process for
+    a `task` consisting of the index of a temperature, the temperature `T` in
+    K, and the pressures `Plist` in Pa at which to compute them. Returns the
+    index, the pressures, the rate coefficients, and the :class:`Profiler` 
+    for the task (or ``None`` if not profiling).
+    """
+    t, T, Plist = task
+    network, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations, E0TS, profiling = workerData
+    profile = None
+    if profiling is not None:
+        from timing import Profiler
+        profile = Profiler(memory=profiling)
+    try:
+        result = network.calculateRateCoefficientsAtTemperature(T, Plist, Elist, densStates0, E0, Ereac, method, collisionTolerance, sumStates, rates0, returnPopulations, E0TS, profile)
+    finally:
+        if profile is not None: profile.close()
+    return t, Plist, result, profile
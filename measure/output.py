@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains functions for saving the results of a MEASURE calculation -- the 
+phenomenological rate coefficients :math:`k(T,P)` and, optionally, the 
+population distributions and fits of the rate coefficients -- to a binary
+file, and for reading them back. The file is an uncompressed NumPy ``.npz``
+archive, so each of its arrays can be memory-mapped rather than read into 
+memory.
+"""
+
+import numpy
+import numpy.lib.format
+import struct
+import zipfile
+import logging
+
+################################################################################
+
+class OutputError(Exception): 
+    """
+    An exception raised when saving or loading MEASURE results is 
+    unsuccessful for any reason. Pass a string describing the cause of the 
+    exceptional behavior.
+    """
+    pass
+
+################################################################################
+
+def getPopulationAxes(method):
+    """
+    Return a tuple naming each of the axes of the population distributions
+    computed at each temperature and pressure using the given `method`, as
+    returned by :meth:`Network.calculateRateCoefficients`. The populations
+    are indexed by energy grain, by isomer, and by the isomer or reactant 
+    channel that is their source (or, for the chemically-significant 
+    eigenvalues method, by chemically-significant eigenmode), in an order 
+    that depends on the method.
+    """
+    method = method.lower()
+    if method == 'modified strong collision':
+        return ('T', 'P', 'grain', 'isomer', 'source')
+    elif method == 'reservoir state':
+        return ('T', 'P', 'grain', 'source', 'isomer')
+    elif method == 'chemically-significant eigenvalues':
+        return ('T', 'P', 'grain', 'isomer', 'eigenmode')
+    raise OutputError('Unknown method "%s".' % method)
+
+def saveResults(path, Tlist, Plist, Elist, labels, K, pa=None, method=None, fit=None):
+    """
+    Save the phenomenological rate coefficients `K`, an array whose first
+    two indices are those of the temperatures `Tlist` in K and pressures
+    `Plist` in Pa, to the file at `path`. The energy grains `Elist` in J/mol
+    and the `labels` of the configurations corresponding to the last two 
+    indices of `K` are saved with them, as are the population distributions
+    `pa` if given. The `method` used to compute the results is also saved, 
+    along with the names of the axes of `pa` for that method (see 
+    :func:`getPopulationAxes`); it must be given if `pa` is. If given, `fit`
+    is the result of :func:`measure.fit.fitRateCoefficients`, whose 
+    Chebyshev coefficients and pressure-dependent Arrhenius parameters are
+    also saved; see :func:`loadFit`.
+    """
+    arrays = {
+        'Tlist': numpy.asarray(Tlist, numpy.float64),
+        'Plist': numpy.asarray(Plist, numpy.float64),
+        'Elist': numpy.asarray(Elist, numpy.float64),
+        'labels': numpy.array([label.encode('utf-8') for label in labels], dtype=numpy.bytes_),
+        'K': numpy.asarray(K, numpy.float64),
+    }
+    if method is not None:
+        arrays['method'] = numpy.array(method.encode('utf-8'), dtype=numpy.bytes_)
+    if pa is not None:
+        if method is None:
+            raise OutputError('The method must be given to save the population distributions.')
+        arrays['pa'] = numpy.asarray(pa, numpy.float64)
+        arrays['paAxes'] = numpy.array([axis.encode('utf-8') for axis in getPopulationAxes(method)], dtype=numpy.bytes_)
+    if fit is not None:
+        (prod, reac), (coeffs, chebError), (A, n, Ea, plogError) = fit
+        arrays['fitReactions'] = numpy.array([prod, reac], numpy.int64)
+        arrays['chebyshev'] = numpy.asarray(coeffs, numpy.float64)
+        arrays['chebyshevError'] = numpy.asarray(chebError, numpy.float64)
+        arrays['plogA'] = numpy.asarray(A, numpy.float64)
+        arrays['plogN'] = numpy.asarray(n, numpy.float64)
+        arrays['plogEa'] = numpy.asarray(Ea, numpy.float64)
+        arrays['plogError'] = numpy.asarray(plogError, numpy.float64)
+    # The file object is passed so that numpy does not append a .npz 
+    # extension to the path
+    f = open(path, 'wb')
+    try:
+        numpy.savez(f, **arrays)
+    finally:
+        f.close()
+    logging.info('Saved k(T,P) results to "%s".' % path)
+
+def loadResults(path, mmap=True):
+    """
+    Load the results saved by :func:`saveResults` from the file at `path`.
+    Returns the temperatures `Tlist` in K, pressures `Plist` in Pa, energy
+    grains `Elist` in J/mol, configuration labels, rate coefficients `K`,
+    population distributions `pa` (``None`` if they were not saved), the 
+    method used to compute them, and the names of the axes of `pa` (each 
+    ``None`` if not saved). If `mmap` is ``True``, the large arrays `K` and
+    `pa` are memory-mapped from the file rather than read into memory.
+    """
+    
+    arrays = readArrays(path, mmap)
+    
+    for name in ['Tlist', 'Plist', 'Elist', 'labels', 'K']:
+        if name not in arrays:
+            raise OutputError('The file "%s" does not contain the array "%s".' % (path, name))
+    
+    labels = [label.decode('utf-8') for label in arrays['labels']]
+    method = arrays['method'][()].decode('utf-8') if 'method' in arrays else None
+    paAxes = tuple([axis.decode('utf-8') for axis in arrays['paAxes']]) if 'paAxes' in arrays else None
+    return arrays['Tlist'], arrays['Plist'], arrays['Elist'], labels, arrays['K'], arrays.get('pa'), method, paAxes
+
+def loadFit(path):
+    """
+    Load the fits of the rate coefficients saved by :func:`saveResults` from
+    the file at `path`, in the form returned by 
+    :func:`measure.fit.fitRateCoefficients`: the indices of the products and
+    reactants of the net reactions, a tuple of the Chebyshev coefficients and
+    errors, and a tuple of the pressure-dependent Arrhenius parameters and 
+    errors. The Chebyshev fits span the range of the saved temperatures and
+    pressures, and the Arrhenius fits are at each of the saved pressures.
+    Returns ``None`` if no fits were saved.
+    """
+    arrays = readArrays(path, False)
+    if 'fitReactions' not in arrays: return None
+    prod, reac = arrays['fitReactions']
+    return (prod, reac), (arrays['chebyshev'], arrays['chebyshevError']), (arrays['plogA'], arrays['plogN'], arrays['plogEa'], arrays['plogError'])
+
+def readArrays(path, mmap=True):
+    """
+    Return a dictionary of the arrays in the ``.npz`` archive at `path`, 
+    indexed by name. If `mmap` is ``True``, the arrays `K` and `pa` are 
+    memory-mapped from the file rather than read into memory.
+    """
+    arrays = {}
+    archive = zipfile.ZipFile(path, 'r')
+    f = open(path, 'rb')
+    try:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if mmap and name in ['K', 'pa'] and info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = mapArray(f, path, info)
+            else:
+                arrays[name] = numpy.lib.format.read_array(archive.open(info))
+    finally:
+        f.close()
+        archive.close()
+    return arrays
+
+def mapArray(f, path, info):
+    """
+    Return a read-only memory map of the array stored uncompressed as the
+    member described by `info` (a :class:`zipfile.ZipInfo` object) of the
+    ``.npz`` archive at `path`, which is open as the file object `f`.
+    """
+    # The member data follows its local file header, whose size depends on
+    # the lengths of the file name and extra field stored in the header
+    f.seek(info.header_offset)
+    header = f.read(30)
+    if header[0:4] != b'PK\x03\x04':
+        raise OutputError('Invalid archive member "%s" in file "%s".' % (info.filename, path))
+    nameLength, extraLength = struct.unpack('<HH', header[26:30])
+    f.seek(info.header_offset + 30 + nameLength + extraLength)
+    # Then parse the header of the .npy data itself
+    version = numpy.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortranOrder, dtype = numpy.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortranOrder, dtype = numpy.lib.format.read_array_header_2_0(f)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortranOrder else 'C')
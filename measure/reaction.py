@@ -32,13 +32,15 @@ Contains functions for working with reaction objects, particularly for
 calculating microcanonical rate coefficients using various methods.
 """
 
+import math
 import numpy
 import logging
 
 import chempy.constants as constants
 import chempy.reaction
 from chempy.kinetics import *
-from chempy.states import convolve
+
+import grains
 
 ################################################################################
 
@@ -52,7 +54,7 @@ class ReactionError(Exception):
 
 ################################################################################
 
-def calculateMicrocanonicalRateCoefficient(reaction, Elist, reacDensStates, prodDensStates=None, T=None):
+def calculateMicrocanonicalRateCoefficient(reaction, Elist, reacDensStates, prodDensStates=None, T=None, sumStates=None, E0=None):
     """
     Calculate the microcanonical rate coefficient :math:`k(E)` for the reaction
     `reaction` at the energies `Elist` in J/mol. `reacDensStates` and 
@@ -68,61 +70,148 @@ def calculateMicrocanonicalRateCoefficient(reaction, Elist, reacDensStates, prod
     * If the above is not possible but high-pressure limit kinetics
       :math:`k_\\infty(T)` have been provided, then the inverse Laplace 
       transform method will be used.
-      
+    
+    For RRKM theory, the sum of states of the transition state `sumStates`,
+    as returned by :func:`calculateSumOfStates`, can be provided to avoid 
+    recomputing it. The ground-state energy of the transition state `E0` in
+    J/mol, on the same scale as `Elist`, is taken from the transition state
+    if not given.
     """
     
     kf = numpy.zeros_like(Elist)
     kr = numpy.zeros_like(Elist)
     
+    if E0 is None: E0 = reaction.transitionState.E0
+    
     if reaction.transitionState.states is not None:
         # We've been provided with molecular degree of freedom data for the
         # transition state, so let's use the more accurate RRKM theory
         logging.debug('Using RRKM theory for reaction "%s"' % reaction)
-        kf = applyRRKMTheory(reaction.transitionState, Elist, reacDensStates)
+        kf = applyRRKMTheory(reaction.transitionState, Elist, reacDensStates, sumStates, E0)
     elif reaction.kinetics is not None:
         # We've been provided with high-pressure-limit rate coefficient data,
         # so let's use the less accurate inverse Laplace transform method
         logging.debug('Using ILT method for reaction "%s"' % reaction)
-        kf = applyInverseLaplaceTransformMethod(reaction.kinetics, reaction.transitionState.E0, Elist, reacDensStates, T)
+        kf = applyInverseLaplaceTransformMethod(reaction.kinetics, E0, Elist, reacDensStates, T)
     
     # If the reaction is reversible, calculate the reverse microcanonical rate
     # using detailed balance
     if reaction.reversible:
-        for r in range(len(Elist)):
-            if prodDensStates[r] > 0: 
-                kr[r] = kf[r] * reacDensStates[r] / prodDensStates[r]
+        nonzero = prodDensStates > 0
+        kr[nonzero] = kf[nonzero] * reacDensStates[nonzero] / prodDensStates[nonzero]
     
     return kf, kr
 
 ################################################################################
 
-def applyRRKMTheory(transitionState, Elist, densStates):
+def isTemperatureDependent(reaction):
+    """
+    Return ``True`` if the microcanonical rate coefficient :math:`k(E)` of 
+    the reaction `reaction`, as computed by 
+    :func:`calculateMicrocanonicalRateCoefficient`, depends on temperature, or
+    ``False`` if it does not. RRKM theory is independent of temperature, as is
+    the inverse Laplace transform method except when the Arrhenius activation
+    energy or temperature exponent is negative, in which case the offending
+    portion is moved into the preexponential at the temperature of interest.
+    """
+    if reaction.transitionState.states is not None:
+        return False
+    elif isinstance(reaction.kinetics, ArrheniusModel):
+        return reaction.kinetics.Ea < 0 or reaction.kinetics.n < 0
+    return True
+
+################################################################################
+
+def calculateSumOfStates(transitionState, Elist, E0=None):
+    """
+    Calculate and return the sum of states of the `transitionState` at the
+    energies `Elist` in J/mol, shifted by the ground-state energy of the 
+    transition state to the common zero of energy. The ground-state energy
+    `E0` in J/mol, on the same scale as `Elist`, is taken from the transition
+    state if not given. Since this does not depend on temperature, it need 
+    only be computed once for a given set of energy grains. If the energy 
+    grains are not evenly spaced, the sum of states is computed on the 
+    underlying uniform lattice and evaluated at each grain.
+    """
+    
+    if E0 is None: E0 = transitionState.E0
+    
+    if not grains.isUniform(Elist):
+        Elattice, indices = grains.getLattice(Elist)
+        return calculateSumOfStates(transitionState, Elattice, E0)[indices]
+    
+    sumStates0 = transitionState.states.getSumOfStates(Elist)
+    # Shift to common zero of energy
+    dE = Elist[1] - Elist[0]
+    r0 = int(round(E0 / dE))
+    sumStates = numpy.zeros_like(sumStates0)
+    sumStates[r0:] = sumStates0[:-r0+len(sumStates0)]
+    
+    return sumStates
+
+def applyRRKMTheory(transitionState, Elist, densStates, sumStates=None, E0=None):
     """
     Calculate the microcanonical rate coefficient for a reaction using RRKM
     theory, where `transitionState` is the transition state of the reaction,
     `Elist` is the array of energies in J/mol at which to evaluate the
     microcanonial rate, and `densStates` is the density of states of the
-    reactant.
+    reactant in mol/J. The sum of states of the transition state `sumStates` 
+    is computed using :func:`calculateSumOfStates`, with the ground-state 
+    energy `E0` in J/mol, if not given.
     """
     
     k = numpy.zeros_like((Elist))
-    Ngrains = len(Elist)
     
     # Calculate sum of states of transition state
-    sumStates0 = transitionState.states.getSumOfStates(Elist)
-    # Shift to common zero of energy
-    r0 = int(round(transitionState.E0 / dE))
-    sumStates[n+Nisom,r0:] = sumStates0[:-r0+len(densStates0)]
+    if sumStates is None:
+        sumStates = calculateSumOfStates(transitionState, Elist, E0)
     
     # Generate k(E) using RRKM formula
-    for r in range(len(Elist)):
-        if densStates[r] > 0:
-            k[r] = sumStates[r] / constants.h / densStates[r]
+    nonzero = densStates > 0
+    k[nonzero] = sumStates[nonzero] / constants.h / constants.Na / densStates[nonzero]
     
     return k
 
 ################################################################################
 
+def convolveByFFT(rho1, rho2, Elist):
+    """
+    Return the convolution
+    
+    .. math:: \\rho(E) = \\int_0^E \\rho_1(x) \\rho_2(E-x) \\, dx
+    
+    of the arrays `rho1` and `rho2` corresponding to the evenly-spaced energies
+    `Elist`, evaluated using fast Fourier transforms in 
+    :math:`O(N \\log N)` time. The error in a convolution evaluated this way
+    is proportional to its largest value, which would swamp the small values
+    at low energies, so both arrays are first multiplied by 
+    :math:`e^{-\\beta E}`, with :math:`\\beta` chosen to flatten `rho2`, 
+    and the result by :math:`e^{\\beta E}`; this leaves the convolution 
+    unchanged but greatly reduces its range of magnitudes.
+    """
+    
+    nE = len(Elist)
+    dE = Elist[1] - Elist[0]
+    
+    # Choose the exponential weighting based on the average logarithmic slope
+    # of the nonzero part of rho2
+    beta = 0.0
+    nonzero = numpy.flatnonzero(rho2 > 0)
+    if len(nonzero) > 1 and nonzero[-1] > nonzero[0]:
+        beta = math.log(rho2[nonzero[-1]] / rho2[nonzero[0]]) / (Elist[nonzero[-1]] - Elist[nonzero[0]])
+    weight = numpy.exp(-beta * (Elist - Elist[0]))
+    
+    # Zero-pad to avoid wraparound
+    size = 2 * nE
+    rho = numpy.fft.irfft(numpy.fft.rfft(rho1 * weight, size) * numpy.fft.rfft(rho2 * weight, size), size)[0:nE]
+    rho *= dE / weight
+    # Remove any roundoff below zero
+    rho[rho < 0] = 0.0
+    
+    return rho
+
+################################################################################
+
 def applyInverseLaplaceTransformMethod(kinetics, E0, Elist, densStates, T=None):
     """
     Calculate the microcanonical rate coefficient for a reaction using the
@@ -130,9 +219,16 @@ def applyInverseLaplaceTransformMethod(kinetics, E0, Elist, densStates, T=None):
     limit rate coefficient, `E0` is the ground-state energy of the transition
     state, `Elist` is the array of energies in J/mol at which to evaluate the
     microcanonial rate, and `densStates` is the density of states of the
-    reactant.
+    reactant. If the energy grains are not evenly spaced, the microcanonical
+    rate is evaluated on the underlying uniform lattice, taking the density 
+    of states to be constant across each grain.
     """
     
+    if not grains.isUniform(Elist):
+        Elattice, indices = grains.getLattice(Elist)
+        densStatesLattice = grains.expandToLattice(densStates, indices, len(Elattice))
+        return applyInverseLaplaceTransformMethod(kinetics, E0, Elattice, densStatesLattice, T)[indices]
+    
     k = numpy.zeros_like((Elist))
     
     if isinstance(kinetics, ArrheniusModel) and (T is not None or (kinetics.Ea >= 0 and kinetics.n >= 0)):
@@ -152,30 +248,26 @@ def applyInverseLaplaceTransformMethod(kinetics, E0, Elist, densStates, T=None):
             A *= T**n
             n = 0.0
 
+        # The microcanonical rate is only nonzero above the transition state
+        # energy, and is evaluated s grains below each energy
+        s = int(math.floor(Ea / dE))
+        active = (Elist > E0) & (densStates != 0)
+        shifted = numpy.flatnonzero(active) - s
+        
         if n == 0:
             # Determine the microcanonical rate directly
-            s = int(math.floor(Ea / dE))
-            for r in range(len(Elist)):
-                if Elist[r] > E0 and densStates[r] != 0:
-                    k[r] = A * densStates[r - s] / densStates[r]
+            k[active] = A * densStates[shifted] / densStates[active]
                     
         elif n > 0.0:
             import scipy.special
             # Evaluate the inverse Laplace transform of the T**n piece, which only
             # exists for n >= 0
             phi = numpy.zeros(len(Elist), numpy.float64)
-            for i, E in enumerate(Elist):
-                if E == 0.0:
-                    phi[i] = 0.0
-                else:
-                    phi[i] = E**(n-1) / (constants.R**n * scipy.special.gamma(n))
+            phi[Elist != 0] = Elist[Elist != 0]**(n-1) / (constants.R**n * scipy.special.gamma(n))
             # Evaluate the convolution
-            phi = convolve(phi, densStates, Elist)
+            phi = convolveByFFT(phi, densStates, Elist)
             # Apply to determine the microcanonical rate
-            s = int(math.floor(Ea / dE))
-            for r in range(len(Elist)):
-                if Elist[r] > E0 and densStates[r] != 0:
-                    k[r] = A * phi[r - s] / densStates[r]
+            k[active] = A * phi[shifted] / densStates[active]
 
     else:
         raise ReactionError('Unable to use inverse Laplace transform method for non-Arrhenius kinetics or for n < 0.')
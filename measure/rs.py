@@ -36,9 +36,15 @@ phenomenological rate coefficients :math:`k(T,P)`.
 import math
 import numpy
 import scipy.linalg
+import scipy.linalg.lapack
+import scipy.sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+import logging
 
 import chempy.constants as constants
 
+from collision import BandedCollisionMatrix
+
 ################################################################################
 
 class ReservoirStateError(Exception): 
@@ -51,130 +57,219 @@ class ReservoirStateError(Exception):
 ################################################################################
 
 def applyReservoirStateMethod(T, P, Elist, densStates, Mcoll, Kij, Fim, Gnj, 
-  Ereac, Nisom, Nreac, Nprod):
+  Ereac, Nisom, Nreac, Nprod, tol=1e-8):
     """
     Use the reservoir state method to reduce the master equation model to a
     set of phenomenological rate coefficients :math:`k(T,P)` and a set of
     time-independent population vectors :math:`\\vector{u}_{ij}` and
     :math:`\\vector{v}_{im}`. Inputs are the temperature `T` in K; pressure `P`
     in Pa; list of energy grains `Elist` in J/mol; dimensionless densities of 
-    states for each isomer and reactant channel `densStates`; collision
-    matrix `Mcoll` for each isomer; isomerization, association, and dissociation
+    states for each isomer and reactant channel `densStates`; a list of 
+    collision matrices `Mcoll`, one per isomer, each a
+    :class:`BandedCollisionMatrix`; isomerization, association, and dissociation
     microcanonical rate coefficients `Kij`, `Fim`, and `Gnj`, respectively;
     energies of the first reactive grain for each isomer `Ereac` in J/mol;
     and the numbers of isomers, reactant channels, and product channels `Nisom`,
     `Nreac`, and `Nprod`, respectively. The method involves a significant linear
     solve, which is accelerated by taking advantage of the bandedness of the
     active-state matrix. The nonreactive grains are placed in the reservoir,
-    while the reactive grains are placed in the active-state.
+    while the reactive grains are placed in the active-state. Collision matrix
+    entries smaller than `tol` times the diagonal entry of their column are
+    left out of the active-state matrix, and the active-state grains are
+    ordered so as to make its bandwidth as small as possible.
+    """
+    K, pa = applyReservoirStateMethodMultiplePressures(T, [P], Elist, densStates, 
+        Mcoll, numpy.ones((1,Nisom), numpy.float64), Kij, Fim, Gnj, Ereac, 
+        Nisom, Nreac, Nprod, tol)
+    return K[0,:,:], pa[0,:,:,:]
+
+def applyReservoirStateMethodMultiplePressures(T, Plist, Elist, densStates, 
+  Pcoll, collFreq, Kij, Fim, Gnj, Ereac, Nisom, Nreac, Nprod, tol=1e-8):
+    """
+    Use the reservoir state method to determine the phenomenological rate
+    coefficients :math:`k(T,P)` and the pseudo-steady population vectors at
+    a single temperature `T` in K and each of the pressures `Plist` in Pa.
+    The collision matrix of isomer `i` at pressure `p` is ``Pcoll[i]`` (a 
+    :class:`BandedCollisionMatrix`) scaled by the collision frequency
+    ``collFreq[p,i]`` in Hz; the other parameters are as for 
+    :func:`applyReservoirStateMethod`. Returns arrays of rate coefficients 
+    and populations whose first index is the pressure.
+    
+    The structure of the active-state matrix does not depend on pressure, so
+    it is determined only once. At each pressure after the first, the system
+    is solved by iterative refinement, starting from the solution at the 
+    previous pressure and using the factorization of the previous matrix as a
+    preconditioner; only if this does not converge quickly is the matrix 
+    factorized again. The refinement is stopped only once every population
+    above the roundoff error of the direct solve has converged to a 
+    relative tolerance of 1e-10, so the results agree with those of 
+    factorizing at every pressure to about that tolerance.
     """
     
     Ngrains = len(Elist)
+    NP = len(Plist)
 
     # Determine the starting grain for the calculation based on the
     # active-state cutoff energy
-    Nres = numpy.zeros(Nisom, numpy.int)
-    for r, E in enumerate(Elist):
-        for i in range(Nisom):
-            if E > Ereac[i] and Nres[i] == 0:
-                Nres[i] = r
+    Nres = numpy.searchsorted(Elist, Ereac, side='right')
+    Nres[Nres == Ngrains] = 0
     Nact = Ngrains - Nres
+    active = numpy.arange(Ngrains).reshape(-1,1) >= Nres
     
     # Determine equilibrium distributions
-    eqDist = numpy.zeros((Nisom+Nreac,Ngrains), numpy.float64)
-    for i in range(Nisom+Nreac):
-        eqDist[i,:] = densStates[i,:] * numpy.exp(-Elist / constants.R / T)
+    eqDist = densStates[0:Nisom+Nreac,:] * numpy.exp(-Elist / constants.R / T)
     
     # Determine pseudo-steady state populations of active state
-    row = 0
-    indices = -numpy.ones((Ngrains,Nisom), numpy.int)
-    for r in range(Ngrains):
-        for i in range(Nisom):
-            if r >= Nres[i]:
-                indices[r,i] = row
-                row += 1
+    # Each active-state grain (r, i) is assigned the row indices[r,i]; the
+    # arrays r and i list the active-state grains in order of row
+    indices = -numpy.ones((Ngrains,Nisom), numpy.int64)
+    indices[active] = numpy.arange(numpy.sum(Nact))
+    r, i = numpy.nonzero(active)
     
-    # Choose the half-bandwidth
-    r = int(Ngrains / 2)
-    tol = 1e-6
-    ratio = numpy.abs(Mcoll[0,:,r] / Mcoll[0,r,r])
-    ind = [i for i,x in enumerate(ratio) if x > tol]
-    halfbandwidth = max(r - min(ind), max(ind) - r) * Nisom
+    # Determine the pairs of active-state grains coupled by collisions, using
+    # the true half-bandwidth of the collision matrix of each isomer
+    collRows = []; collCols = []; collData = []
+    for j in range(Nisom):
+        h = Pcoll[j].halfbandwidth
+        k, s = numpy.indices(Pcoll[j].data.shape)
+        t = s + k - h
+        mask = (t >= Nres[j]) & (t < Ngrains) & (s >= Nres[j]) & (abs(k - h) <= Pcoll[j].getHalfbandwidth(tol))
+        collRows.append(indices[t[mask],j]); collCols.append(indices[s[mask],j]); collData.append(Pcoll[j].data[mask])
+    collRows = numpy.concatenate(collRows); collCols = numpy.concatenate(collCols); collData = numpy.concatenate(collData)
+    # Determine the pairs of active-state grains coupled by isomerization
+    rr, ii, jj = numpy.nonzero(active[:,:,numpy.newaxis] & active[:,numpy.newaxis,:] & ~numpy.eye(Nisom, dtype=bool))
+    
+    # Choose the ordering of the active-state grains that gives the smaller
+    # half-bandwidth: either the grains of all isomers interleaved in order of
+    # energy, or a reverse Cuthill-McKee ordering of the couplings
+    rows = numpy.concatenate([collRows, indices[rr,ii]])
+    cols = numpy.concatenate([collCols, indices[rr,jj]])
+    halfbandwidth = int(numpy.max(numpy.abs(rows - cols)))
+    pattern = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, cols)), shape=(numpy.sum(Nact),numpy.sum(Nact)))
+    order = numpy.empty(numpy.sum(Nact), numpy.int64)
+    order[reverse_cuthill_mckee(pattern, symmetric_mode=True)] = numpy.arange(numpy.sum(Nact))
+    if numpy.max(numpy.abs(order[rows] - order[cols])) < halfbandwidth:
+        halfbandwidth = int(numpy.max(numpy.abs(order[rows] - order[cols])))
+        indices[active] = order[indices[active]]
+        collRows = order[collRows]; collCols = order[collCols]
+        logging.debug('Using reverse Cuthill-McKee ordering of active-state grains.')
     bandwidth = 2 * halfbandwidth + 1
+    logging.debug('Using half-bandwidth of %i for %i active-state grains (about %.3g flops for the banded solve).' % (halfbandwidth, numpy.sum(Nact), 
+        2.0 * numpy.sum(Nact) * halfbandwidth * (2 * halfbandwidth + 1) + 2.0 * numpy.sum(Nact) * (3 * halfbandwidth + 1) * (Nisom + Nreac)))
     
-    # Populate active-state matrix and source vectors
-    L = numpy.zeros((bandwidth,numpy.sum(Nact)), numpy.float64)
-    Z = numpy.zeros((numpy.sum(Nact),Nisom+Nreac), numpy.float64)
+    # Collisional transfer from the reservoir of each isomer (per unit 
+    # collision frequency)
+    eqRes = eqDist[0:Nisom,:] * ~active.T
+    Mres = numpy.zeros((Nisom,Ngrains), numpy.float64)
+    for j in range(Nisom):
+        Mres[j,:] = Pcoll[j].dot(eqRes[j,:])
+    
+    # Populate the pressure-independent parts of the active-state matrix and
+    # source vectors, keeping the collisional terms (per unit collision
+    # frequency) separate from the reactive terms
+    Lcoll = numpy.zeros((bandwidth,numpy.sum(Nact)), numpy.float64)
+    Lrxn = numpy.zeros((bandwidth,numpy.sum(Nact)), numpy.float64)
+    Zcoll = numpy.zeros((numpy.sum(Nact),Nisom+Nreac), numpy.float64)
+    Zrxn = numpy.zeros((numpy.sum(Nact),Nisom+Nreac), numpy.float64)
     # Collisional terms
-    for i in range(Nisom):
-        for r in range(Nres[i], Ngrains):
-            for s in range(max(Nres[i], r-halfbandwidth/Nisom), min(Ngrains, r+halfbandwidth/Nisom)):
-                L[halfbandwidth + indices[r,i] - indices[s,i], indices[s,i]] = Mcoll[i,r,s]
-            Z[indices[r,i],i] = numpy.sum(Mcoll[i,r,0:Nres[i]] * eqDist[i,0:Nres[i]])
-    # Isomerization terms
-    for i in range(Nisom):
-        for j in range(i):
-            for r in range(max(Nres[i], Nres[j]), Ngrains):
-                L[halfbandwidth + indices[r,j] - indices[r,i], indices[r,i]] = Kij[j,i,r]
-                L[halfbandwidth, indices[r,i]] -= Kij[j,i,r]
-                L[halfbandwidth + indices[r,i] - indices[r,j], indices[r,j]] = Kij[i,j,r]
-                L[halfbandwidth, indices[r,j]] -= Kij[i,j,r]
+    Lcoll[halfbandwidth + collRows - collCols, collCols] = collData
+    Zcoll[indices[r,i],i] = Mres[i,r]
+    # Isomerization terms between grains that are active in both isomers
+    Lrxn[halfbandwidth + indices[rr,jj] - indices[rr,ii], indices[rr,ii]] = Kij[jj,ii,rr]
+    Kloss = numpy.zeros(numpy.sum(Nact), numpy.float64)
+    numpy.add.at(Kloss, indices[rr,ii], Kij[jj,ii,rr])
     # Dissociation/association terms
-    for i in range(Nisom):
-        for n in range(Nreac+Nprod):
-            for r in range(Nres[i], Ngrains):
-                L[halfbandwidth, indices[r,i]] -= Gnj[n,i,r]
-        for n in range(Nreac):
-            for r in range(Nres[i], Ngrains):
-                Z[indices[r,i], n+Nisom] = Fim[i,n,r] * eqDist[n+Nisom,r]
+    Lrxn[halfbandwidth, indices[r,i]] -= Kloss[indices[r,i]] + numpy.sum(Gnj[:,i,r], axis=0)
+    Zrxn[indices[r,i],Nisom:] = Fim[i,:,r] * eqDist[Nisom:,r].T
+    
+    # The isomer to which each active-state grain belongs, used to apply the
+    # collision frequencies
+    isomer = numpy.zeros(numpy.sum(Nact), numpy.int64)
+    isomer[indices[r,i]] = i
+    
+    # Work arrays reused at every pressure
+    L = numpy.zeros((bandwidth,numpy.sum(Nact)), numpy.float64)
+    Z = numpy.zeros((numpy.sum(Nact),Nisom+Nreac), numpy.float64)
+    LU = None; X = None; refine = True
+    offsets = halfbandwidth - numpy.arange(bandwidth)
+    
+    K = numpy.zeros((NP,Nisom+Nreac+Nprod,Nisom+Nreac+Nprod), numpy.float64)
+    pa = numpy.zeros((NP,Ngrains,Nisom+Nreac,Nisom), numpy.float64)
+    
+    for p in range(NP):
         
-    # Solve for pseudo-steady state populations of active state
-    X = scipy.linalg.solve_banded((halfbandwidth,halfbandwidth), L, -Z, overwrite_ab=True, overwrite_b=True)
-    pa = numpy.zeros((Ngrains,Nisom+Nreac,Nisom), numpy.float64)
-    for i in range(Nisom):
-        for r in range(Nres[i], Ngrains):
-            for n in range(Nisom+Nreac):
-                pa[r,n,i] = X[indices[r,i], n]
+        # Assemble the active-state matrix and source vectors at this pressure
+        freq = collFreq[p,isomer]
+        numpy.multiply(Lcoll, freq, L); L += Lrxn
+        numpy.multiply(Zcoll, freq.reshape(-1,1), Z); Z += Zrxn
+        Z *= -1
+        
+        # Solve for pseudo-steady state populations of active state
+        # First try iterative refinement from the previous solution, using the
+        # previous factorization as a preconditioner; this is abandoned (and
+        # not tried again at this temperature) if the corrections do not
+        # shrink quickly enough to converge within a few iterations, or if it
+        # gives negative populations, in which case the matrix is factorized
+        converged = False
+        if refine and LU is not None:
+            A = BandedCollisionMatrix(L, halfbandwidth)
+            dXlast = None
+            for iter in range(4):
+                dX, info = scipy.linalg.lapack.dgbtrs(LU, halfbandwidth, halfbandwidth, Z - A.dot(X), ipiv)
+                X += dX
+                # Each population must have converged to a relative 
+                # tolerance of 1e-10, except those that are below the 
+                # roundoff error of the direct solve, taken to be 1e-14 times
+                # the largest population for the same source; the test is
+                # applied to each source separately, since their scales can
+                # differ by many orders of magnitude
+                dX = numpy.abs(dX)
+                if (dX <= 1e-10 * numpy.abs(X) + 1e-14 * numpy.abs(X).max(axis=0)).all():
+                    converged = (X >= 0).all()
+                    break
+                dX = numpy.max(dX / (numpy.abs(X).max(axis=0) + 1e-300))
+                if dXlast is not None and dX > 0.1 * dXlast:
+                    break
+                dXlast = dX
+            if not converged:
+                logging.debug('Iterative refinement did not converge at %g bar; factorizing at all remaining pressures.' % (Plist[p] / 1e5))
+                refine = False
+        if not converged:
+            ab = numpy.zeros((3*halfbandwidth+1,numpy.sum(Nact)), numpy.float64)
+            ab[halfbandwidth:,:] = L
+            LU, ipiv, info = scipy.linalg.lapack.dgbtrf(ab, halfbandwidth, halfbandwidth, overwrite_ab=True)
+            if info > 0:
+                raise ReservoirStateError('The active-state matrix is singular.')
+            X, info = scipy.linalg.lapack.dgbtrs(LU, halfbandwidth, halfbandwidth, Z, ipiv)
+        else:
+            logging.debug('Refined active-state solution at %g bar in %i iterations.' % (Plist[p] / 1e5, iter + 1))
+        pa[p,r,:,i] = X[indices[r,i],:]
     
-    # Double-check to ensure that we have all positive populations
-    if not (pa >= 0).all():
-        raise ReservoirStateError('A negative steady-state population was encountered.')
+        # Double-check to ensure that we have all positive populations
+        if not (pa[p] >= 0).all():
+            raise ReservoirStateError('A negative steady-state population was encountered.')
 
-    # Determine the phenomenological rate coefficients
-    K = numpy.zeros((Nisom+Nreac+Nprod, Nisom+Nreac+Nprod), numpy.float64)
-    # Rows relating to isomers
-    for i in range(Nisom):
+        # Determine the phenomenological rate coefficients
+        # Rows relating to isomers
         # Collisional rearrangement within the reservoir of isomer i
-        K[i,i] += numpy.sum(numpy.dot(Mcoll[i,0:Nres[i],0:Nres[i]], eqDist[i,0:Nres[i]]))
-        # Isomerization from isomer j to isomer i
+        K[p,range(Nisom),range(Nisom)] += numpy.sum(Mres * ~active.T, axis=1) * collFreq[p,:]
         for j in range(Nisom):
-            K[i,j] += numpy.sum(numpy.dot(Mcoll[i,0:Nres[i],Nres[i]:Ngrains], pa[Nres[i]:Ngrains,j,i]))
-        # Association from reactant n to isomer i
-        for n in range(Nisom, Nisom+Nreac):
-            K[i,n] += numpy.sum(numpy.dot(Mcoll[i,0:Nres[i],Nres[i]:Ngrains], pa[Nres[i]:Ngrains,n,i]))
-    # Rows relating to reactants
-    for n in range(Nreac):
-        # Association loss
-        for i in range(Nisom):
-            K[Nisom+n,Nisom+n] -= numpy.sum(Fim[i,n,:] * eqDist[n+Nisom,:])
-        # Reaction from isomer or reactant j to reactant n
-        for j in range(Nisom+Nreac):
-            for i in range(Nisom):
-                K[Nisom+n,j] += numpy.sum(Gnj[n,i,Nres[i]:Ngrains] * pa[Nres[i]:Ngrains,j,i])
-    # Rows relating to products
-    for n in range(Nreac, Nreac+Nprod):
-        # Reaction from isomer or reactant j to product n
-        for j in range(Nisom+Nreac):
-            for i in range(Nisom):
-                K[Nisom+n,j] += numpy.sum(Gnj[n,i,Nres[i]:Ngrains] * pa[Nres[i]:Ngrains,j,i])
+            # Isomerization from isomer k to isomer j and association from 
+            # reactant n to isomer j
+            # (pa is still zero within the reservoir at this point)
+            K[p,j,0:Nisom+Nreac] += numpy.sum(Pcoll[j].dot(pa[p,:,:,j])[0:Nres[j],:], axis=0) * collFreq[p,j]
+        # Rows relating to reactants: association loss
+        K[p,range(Nisom,Nisom+Nreac),range(Nisom,Nisom+Nreac)] -= numpy.einsum('inr,nr->n', Fim, eqDist[Nisom:,:])
+        # Rows relating to reactants and products: reaction from isomer or
+        # reactant j to reactant or product n
+        K[p,Nisom:,0:Nisom+Nreac] += numpy.einsum('nir,rji->nj', Gnj, pa[p])
+            
+        # Ensure matrix is conservative
+        K[p,range(Nisom+Nreac),range(Nisom+Nreac)] -= numpy.sum(K[p,:,0:Nisom+Nreac], axis=0)
         
-    # Ensure matrix is conservative
-    for n in range(Nisom+Nreac):
-        K[n,n] -= numpy.sum(K[:,n])
-    
     # Put the reservoir populations into pa as well
-    for i in range(Nisom):
-        pa[0:Nres[i],i,i] = eqDist[i,0:Nres[i]]
+    r, i = numpy.nonzero(~active)
+    pa[:,r,i,i] = eqDist[i,r]
 
     # Return the matrix of k(T,P) values and the pseudo-steady population distributions
     return K, pa
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains a long-running MEASURE service, for programs such as mechanism 
+generators that need the rate coefficients of many networks and would 
+otherwise pay the cost of starting MEASURE for each one. Requests are read
+as JSON objects, one per line, from standard input or from connections to a
+Unix socket, and are handled by a pool of worker processes that stay 
+resident (along with their densities of states cache) between requests. 
+Each response is written as a JSON object on one line, as soon as it is
+ready, so responses may arrive in a different order from the requests.
+Each worker keeps at most a fixed number of densities of states in memory,
+dropping the least recently used, so that a long-running service does not
+grow without bound.
+
+Any client can send requests, so input files named by ``path`` and output
+files named by ``output`` are only accepted if the service is given a root
+directory, and must lie within it (relative paths are relative to it). 
+Otherwise, networks can only be given inline by ``input``.
+
+A request contains the following keys, of which only one of ``path`` and
+``input`` is required:
+
+=============== ================================================================
+Key             Description
+=============== ================================================================
+``id``          An identifier, returned unchanged in the response
+``path``        The path of a MEASURE input file describing the network, within the root directory
+``input``       The contents of a MEASURE input file describing the network
+``tolerance``   The collision tolerance to use (default is 1e-8)
+``output``      The path of a file within the root directory in which to also save the results (and fits)
+``fit``         If ``true``, return fits of the rate coefficients of each net reaction
+``K``           If ``false``, do not return the rate coefficients themselves
+=============== ================================================================
+
+The response contains the ``id``, a ``status`` of ``"ok"`` or ``"error"``,
+and either a ``message`` describing the error or the ``Tlist``, ``Plist``,
+``labels``, and (unless not requested) ``K`` and ``fits`` of the result. If
+the rate coefficients could not be fitted, the response instead contains a
+``fitError`` describing why.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import threading
+import logging
+
+from batch import initializeBatchWorker
+
+################################################################################
+
+def getRequestPath(request, key, rootDirectory=None):
+    """
+    Return the absolute path given by the `key` of the `request`, relative 
+    to `rootDirectory`, or ``None`` if the request does not contain the key.
+    Raises a :class:`ValueError` if no `rootDirectory` is given or the path
+    (after following any symbolic links) is not within it.
+    """
+    path = request.get(key)
+    if path is None: return None
+    if rootDirectory is None:
+        raise ValueError('The "%s" key cannot be used unless the server is given a root directory.' % key)
+    root = os.path.realpath(rootDirectory)
+    path = os.path.realpath(os.path.join(root, path))
+    if not path.startswith(os.path.join(root, '')):
+        raise ValueError('The path "%s" given by "%s" is not within the root directory.' % (request[key], key))
+    return path
+
+def processRequest(request, rootDirectory=None):
+    """
+    Handle a single `request`, a dictionary decoded from the JSON request,
+    and return the response as a dictionary. Any error is reported in the
+    response rather than raised. Input and output files named in the request
+    must be within `rootDirectory`; see :func:`getRequestPath`.
+    """
+    
+    import batch
+    from output import saveResults
+    from fit import fitRateCoefficients, FitError
+    
+    response = {'id': request.get('id')}
+    temp = None
+    try:
+        path = getRequestPath(request, 'path', rootDirectory)
+        outputPath = getRequestPath(request, 'output', rootDirectory)
+        if request.get('input') is not None:
+            fd, temp = tempfile.mkstemp(suffix='.py')
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(request['input'])
+            finally:
+                f.close()
+            path = temp
+        if path is None:
+            raise ValueError('The request must contain either "path" or "input".')
+        
+        network, Tlist, Plist, Elist, method = batch.loadNetwork(path)
+        network.statesCache = batch.workerStatesCache
+        K = network.calculateRateCoefficients(Tlist, Plist, Elist, method, collisionTolerance=request.get('tolerance', 1e-8))
+        labels = network.getConfigurationLabels()
+        
+        response['status'] = 'ok'
+        response['Tlist'] = [float(T) for T in Tlist]
+        response['Plist'] = [float(P) for P in Plist]
+        response['labels'] = labels
+        if request.get('K', True):
+            response['K'] = K.tolist()
+        fit = None
+        if request.get('fit', False):
+            try:
+                fit = fitRateCoefficients(network, Tlist, Plist, K)
+                (prod, reac), (coeffs, chebError), (A, n, Ea, plogError) = fit
+            except FitError, e:
+                logging.warning('Unable to fit the rate coefficients for request %s: %s' % (request.get('id'), e))
+                response['fitError'] = str(e)
+            else:
+                response['fits'] = [{
+                    'reactants': labels[reac[i]],
+                    'products': labels[prod[i]],
+                    'chebyshev': {'coeffs': coeffs[i].tolist(), 'Tmin': float(min(Tlist)), 'Tmax': float(max(Tlist)), 
+                        'Pmin': float(min(Plist)), 'Pmax': float(max(Plist)), 'error': float(chebError[i])},
+                    'plog': {'P': response['Plist'], 'A': A[:,i].tolist(), 'n': n[:,i].tolist(), 'Ea': Ea[:,i].tolist(), 
+                        'error': float(plogError[i])},
+                } for i in range(len(prod))]
+        if outputPath is not None:
+            saveResults(outputPath, Tlist, Plist, Elist, labels, K, method=method, fit=fit)
+    except Exception, e:
+        logging.error('Request %s failed: %s' % (request.get('id'), e))
+        response = {'id': request.get('id'), 'status': 'error', 'message': '%s: %s' % (e.__class__.__name__, e)}
+    finally:
+        if temp is not None and os.path.exists(temp): os.remove(temp)
+    
+    return response
+
+################################################################################
+
+def serveStream(pool, reader, writer, rootDirectory=None):
+    """
+    Read requests, one JSON object per line, from the file object `reader`
+    until it is exhausted, handling each in the worker `pool` and writing 
+    each response to the file object `writer` as soon as it is ready. Files
+    named in the requests must be within `rootDirectory`. The
+    responses are written by a thread of this stream rather than by the 
+    pool, so that a client that disconnects cannot stop the pool from 
+    handling other requests.
+    """
+    
+    import Queue
+    import socket
+    
+    responses = Queue.Queue()
+    def send():
+        while True:
+            response = responses.get()
+            if response is None: break
+            try:
+                writer.write(json.dumps(response) + '\n')
+                writer.flush()
+            except (IOError, socket.error), e:
+                # The client has gone away, so discard the remaining responses
+                logging.warning('Unable to send the response to request %s: %s' % (response.get('id'), e))
+                while responses.get() is not None: pass
+                break
+    sender = threading.Thread(target=send)
+    sender.daemon = True
+    sender.start()
+    
+    pending = []
+    try:
+        for line in iter(reader.readline, ''):
+            line = line.strip()
+            if line == '': continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict): raise ValueError('the request is not a JSON object')
+            except ValueError, e:
+                responses.put({'id': None, 'status': 'error', 'message': 'Invalid request: %s' % e})
+                continue
+            pending.append(pool.apply_async(processRequest, (request, rootDirectory), callback=responses.put))
+    finally:
+        # Wait for the responses to any outstanding requests to be sent
+        for result in pending:
+            result.wait()
+        responses.put(None)
+        sender.join()
+
+def serveConnection(pool, connection, rootDirectory=None):
+    """
+    Serve the requests sent over the socket `connection`, whose files must 
+    be within `rootDirectory`.
+    """
+    try:
+        serveStream(pool, connection.makefile('r'), connection.makefile('w'), rootDirectory)
+    finally:
+        connection.close()
+
+def runServer(workers=1, cacheDirectory=None, socketPath=None, rootDirectory=None, cacheSize=256):
+    """
+    Run the MEASURE service with a pool of `workers` processes that share 
+    the densities of states cache in `cacheDirectory`, if given, each 
+    keeping at most `cacheSize` densities of states in memory. Requests 
+    are read from standard input until it is closed, or, if `socketPath` is
+    given, from any number of connections to a Unix socket at that path 
+    (which only its owner can connect to) until the service is interrupted.
+    Input and output files named in the requests must be within 
+    `rootDirectory`; if it is not given, only inline inputs are accepted.
+    """
+    
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, initializer=initializeBatchWorker, initargs=(cacheDirectory, cacheSize))
+    try:
+        if socketPath is None:
+            logging.info('Reading requests from standard input...')
+            serveStream(pool, sys.stdin, sys.stdout, rootDirectory)
+        else:
+            import socket
+            if os.path.exists(socketPath): os.remove(socketPath)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(socketPath)
+            os.chmod(socketPath, 0600)
+            server.listen(5)
+            logging.info('Listening for requests on "%s"...' % socketPath)
+            try:
+                while True:
+                    connection, address = server.accept()
+                    thread = threading.Thread(target=serveConnection, args=(pool, connection, rootDirectory))
+                    thread.daemon = True
+                    thread.start()
+            finally:
+                server.close()
+                os.remove(socketPath)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#   MEASURE - Master Equation Automatic Solver for Unimolecular REactions
+#
+#   Copyright (c) 2010 by Joshua W. Allen (jwallen@mit.edu)
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the 'Software'),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+
+"""
+Contains a profiler for recording where the time and memory go in a MEASURE
+calculation. A :class:`Profiler` object is passed as the `profile` argument
+of :meth:`Network.calculateRateCoefficients`, which then records the wall 
+time, number of calls, and size of the arrays allocated by each stage of 
+the calculation and at each temperature and pressure; when no profiler is
+given, none of this is recorded. The arrays are those that each stage 
+reports to the profiler (its results, such as the densities of states or 
+the collision matrices), since Python 2 offers no way to trace the memory
+allocated for NumPy arrays; temporary arrays freed within a stage are not 
+counted. The peak resident memory of the whole process is recorded as well.
+"""
+
+import json
+import time
+import logging
+import contextlib
+
+################################################################################
+
+def getMaximumResidentMemory():
+    """
+    Return the peak resident memory of the process in bytes, or 0 if it 
+    cannot be determined.
+    """
+    try:
+        import resource
+        # ru_maxrss is in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, AttributeError):
+        return 0
+
+def getArraySize(obj):
+    """
+    Return the total size in bytes of the NumPy array `obj`, or of all of the
+    arrays in `obj` if it is a list or tuple of them (which may be nested and
+    may contain ``None``).
+    """
+    if obj is None:
+        return 0
+    elif isinstance(obj, (list, tuple)):
+        return sum([getArraySize(item) for item in obj])
+    return getattr(obj, 'nbytes', 0)
+
+@contextlib.contextmanager
+def profiled(profile, stage, T=None, P=None):
+    """
+    Return a context manager that times the code it runs as the stage named
+    `stage` of the :class:`Profiler` object `profile`, recording it as a 
+    point at temperature `T` in K and pressure `P` in Pa if given (see 
+    :meth:`Profiler.stop`), or does nothing if `profile` is ``None``.
+    """
+    if profile is None:
+        yield
+        return
+    profile.start(stage)
+    try:
+        yield
+    finally:
+        profile.stop(stage, T, P)
+
+def allocated(profile, *arrays):
+    """
+    Record the given `arrays` as allocated by the stages of the 
+    :class:`Profiler` object `profile` that are running (see 
+    :meth:`Profiler.allocate`), or do nothing if `profile` is ``None``.
+    """
+    if profile is not None:
+        profile.allocate(*arrays)
+
+################################################################################
+
+class Profiler:
+    """
+    A record of the time and memory used by each stage of a calculation. The
+    attributes are:
+    
+    =============== =========== ================================================
+    Attribute       Type        Description
+    =============== =========== ================================================
+    `stages`        ``dict``    The total wall time in s, number of calls, and largest size of the arrays allocated in bytes for each stage, indexed by stage name
+    `points`        ``list``    The stage, temperature in K, pressure in Pa, wall time in s, and size of the arrays allocated in bytes at each point
+    `memory`        ``bool``    ``True`` if memory is measured, or ``False`` if not
+    `maxrss`        ``int``     The peak resident memory of the process in bytes, once recorded by :meth:`close`
+    =============== =========== ================================================
+    
+    Each stage is timed between calls to :meth:`start` and :meth:`stop`, 
+    which may be nested. The memory recorded for a stage is the total size 
+    of the arrays reported to :meth:`allocate` while it (or any stage nested
+    within it) ran. If `memory` is ``False``, memory is not measured.
+    """
+    
+    def __init__(self, memory=True):
+        self.stages = {}
+        self.points = []
+        self.stack = []
+        self.memory = memory
+        self.maxrss = None
+    
+    def __getstate__(self):
+        """
+        Return the state of the profiler for pickling. The stages in progress
+        are not kept.
+        """
+        return {'stages': self.stages, 'points': self.points, 'memory': self.memory, 'maxrss': self.maxrss}
+    
+    def __setstate__(self, state):
+        """
+        Restore the state of the profiler after unpickling.
+        """
+        self.stages = state['stages']
+        self.points = state['points']
+        self.memory = state['memory']
+        self.maxrss = state['maxrss']
+        self.stack = []
+    
+    def close(self):
+        """
+        Record the peak resident memory of the process, if memory is 
+        measured. No more stages should be timed afterward.
+        """
+        if self.memory:
+            self.maxrss = max(self.maxrss, getMaximumResidentMemory())
+    
+    def allocate(self, *arrays):
+        """
+        Record the NumPy `arrays` (or lists of them) as allocated by each of
+        the stages that are running.
+        """
+        if not self.memory: return
+        size = getArraySize(arrays)
+        for frame in self.stack:
+            frame[2] += size
+    
+    def start(self, stage):
+        """
+        Start timing the stage named `stage`.
+        """
+        self.stack.append([stage, time.time(), 0])
+    
+    def stop(self, stage, T=None, P=None):
+        """
+        Stop timing the stage named `stage`, which must be the most recently
+        started stage still running, and return a tuple of the wall time in s
+        and size of the arrays allocated in bytes. If a temperature `T` in K
+        is given, the stage is also recorded as a point at that temperature 
+        and the pressure `P` in Pa, which is ``None`` for a stage that covers
+        all of the pressures at once.
+        """
+        name, t0, memory = self.stack.pop()
+        if name != stage:
+            raise ValueError('Attempted to stop stage "%s" while stage "%s" was running.' % (stage, name))
+        elapsed = time.time() - t0
+        self.record(stage, elapsed, 1, memory)
+        if T is not None:
+            self.points.append({'stage': stage, 'T': float(T), 'P': float(P) if P is not None else None, 'time': elapsed, 'memory': memory})
+        return elapsed, memory
+    
+    def record(self, stage, elapsed, calls, memory):
+        """
+        Add `calls` calls of the stage named `stage`, taking a total wall time
+        of `elapsed` in s and allocating arrays of at most `memory` bytes, to
+        the profile.
+        """
+        if stage not in self.stages:
+            self.stages[stage] = {'time': 0.0, 'calls': 0, 'memory': 0}
+        self.stages[stage]['time'] += elapsed
+        self.stages[stage]['calls'] += calls
+        self.stages[stage]['memory'] = max(self.stages[stage]['memory'], memory)
+    
+    def merge(self, other):
+        """
+        Add the stages and points recorded by the profiler `other` (e.g. in a
+        worker process) to this profile. The peak resident memory is that of
+        whichever process used the most.
+        """
+        for stage, data in other.stages.items():
+            self.record(stage, data['time'], data['calls'], data['memory'])
+        self.points.extend(other.points)
+        self.maxrss = max(self.maxrss, other.maxrss)
+    
+    def getReport(self):
+        """
+        Return the profile as a dictionary suitable for saving as JSON.
+        """
+        return {
+            'memory': self.memory,
+            'maxrss': self.maxrss,
+            'stages': self.stages,
+            'points': sorted(self.points, key=lambda point: (point['T'], point['P'] or 0.0, point['stage'])),
+        }
+    
+    def save(self, path):
+        """
+        Save the profile as JSON to the file at `path`.
+        """
+        f = open(path, 'w')
+        try:
+            json.dump(self.getReport(), f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+    
+    def log(self, level=logging.INFO):
+        """
+        Log a summary of the time and memory used by each stage at the given
+        logging `level`.
+        """
+        logging.log(level, '')
+        logging.log(level, '%-24s %12s %8s %12s' % ('Stage', 'Time (s)', 'Calls', 'Arrays (MB)'))
+        for stage, data in sorted(self.stages.items(), key=lambda item: -item[1]['time']):
+            logging.log(level, '%-24s %12.3f %8d %12.1f' % (stage, data['time'], data['calls'], data['memory'] / 1048576.0))
+        if self.maxrss:
+            logging.log(level, 'Peak resident memory: %.1f MB' % (self.maxrss / 1048576.0))
+        logging.log(level, '')